@@ -0,0 +1,266 @@
+"""
+    **xcelbench.py**
+
+    Benchmarks of the Xcel lookup and write paths on synthetic catalogs.
+
+    The catalogs are generated in the layout of the data files: "Table" in
+    column C with its number in column D, the HEADINGS, UNITS, MARKS and
+    REFERENCE rows below it, the labels in column C, the descriptions in
+    column E and the data from column F (6).  Each workbook has two sheets
+    of two tables; "rows" is the number of data rows of each table.
+
+    Usage
+
+        python benchmarks/xcelbench.py                         # Print the results
+        python benchmarks/xcelbench.py --out results.json       # Save them
+        python benchmarks/xcelbench.py --baseline benchmarks/baseline.json
+        python benchmarks/xcelbench.py --save-baseline          # Replace the stored baseline
+
+    With --baseline the results are compared with the stored ones and the
+    exit status is 1 if a timing is more than --tolerance times slower.
+    The timings are the best of --repeat rounds, in seconds (see run); the
+    timings of a few microseconds are the best of FASTREPEAT times as many
+    runs, each of FASTLOOPS passes.
+
+    A fixed pure Python loop is timed with each size ("calibration").  The
+    comparison divides every timing by the calibration of its own size and
+    run, so a baseline saved on a faster or a slower machine can still be
+    used.  This only corrects for the speed of the processor: the stored
+    baseline is from one machine, and it is best to save a new one
+    (--save-baseline) on the machine that runs the comparison.  On a shared
+    machine the speed changes from minute to minute; more rounds (--repeat)
+    make the comparison steadier.
+"""
+
+import argparse
+import gc
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+from openpyxl import Workbook
+from melib.excel import Xcel, copyfile, compilefile
+
+BASELINE = os.path.join(os.path.dirname(os.path.realpath(__file__)), "baseline.json")
+SIZES = [100, 1000, 5000]
+NCOLUMNS = 8
+SHEETS = ["steel", "alum"]
+FASTREPEAT = 5  # More runs for the timings of a few microseconds
+FASTLOOPS = 20
+MINTIME = 0.1  # Seconds of runs for each timing in each round (see sampled)
+
+
+def headings():
+    return ["H%d" % j for j in range(NCOLUMNS)]
+
+
+def label(table_num, i):
+    return "T%d-%05d" % (table_num, i)
+
+
+# A synthetic catalog with "rows" data rows per table
+def makecatalog(filename, rows):
+    wb = Workbook()
+    wb.remove(wb.active)
+    for sheetname in SHEETS:
+        ws = wb.create_sheet(title=sheetname)
+        ws.cell(row=2, column=3, value="NOFTABLES")
+        ws.cell(row=2, column=6, value=2)
+        r = 4
+        for table_num in [1, 2]:
+            ws.cell(row=r, column=3, value="Table")
+            ws.cell(row=r, column=4, value=table_num)
+            ws.cell(row=r, column=5, value="Synthetic table %d" % table_num)
+            for (k, name) in enumerate(["HEADINGS", "UNITS", "MARKS", "REFERENCE"]):
+                ws.cell(row=r+1+k, column=3, value=name)
+            for (j, h) in enumerate(headings()):
+                ws.cell(row=r+1, column=6+j, value=h)
+                ws.cell(row=r+2, column=6+j, value="MPA")
+                ws.cell(row=r+4, column=6+j, value="xcelbench")
+            r += 5
+            for i in range(rows):
+                s = label(table_num, i)
+                ws.cell(row=r, column=3, value=s)
+                ws.cell(row=r, column=5, value=s)
+                for j in range(NCOLUMNS):
+                    ws.cell(row=r, column=6+j, value=float(i*NCOLUMNS+j))
+                r += 1
+            r += 2  # Empty rows between the tables
+    wb.save(filename)
+
+
+# The time of one call of "f".  The garbage collector is off, as in timeit.
+def timed(f):
+    gc.disable()
+    try:
+        t0 = time.perf_counter()
+        f()
+        return time.perf_counter()-t0
+    finally:
+        gc.enable()
+
+
+# The best time of "f" over MINTIME seconds (at least one call), for the
+# timings of a few milliseconds
+def sampled(f):
+    t = [timed(f)]
+    while sum(t) < MINTIME:
+        t.append(timed(f))
+    return min(t)
+
+
+# The time of one of the n lookups of "f", the best of FASTREPEAT samples
+# of FASTLOOPS calls
+def fast(f, n):
+    def loops():
+        for k in range(FASTLOOPS):
+            f()
+    return min([timed(loops) for k in range(FASTREPEAT)])/(n*FASTLOOPS)
+
+
+# A fixed amount of pure Python work (dictionary lookups, arithmetic and
+# string formatting, as in the lookups), to compare the speed of two runs
+def calibration():
+    d = {}
+    for i in range(100000):
+        d["T%05d" % (i % 5000)] = i*0.5
+    z = 0.0
+    for i in range(100000):
+        z += d["T%05d" % (i % 5000)]
+    return z
+
+
+# The benchmarks of one size: [(name, timer)], where timer() returns the
+# time of one run in seconds
+def benchsize(folder, rows):
+    filename = os.path.join(folder, "catalog%d.xlsx" % rows)
+    makecatalog(filename, rows)
+    compilefile(filename)
+    names = [label(2, i) for i in range(0, rows, max(1, rows//200))]
+    hs = headings()
+    x = Xcel(filename, "steel")
+    x.vit(2, names[0], hs[0])
+    x.getrow(names[0])
+
+    def first():  # On a fresh load, so that the table index is built
+        y = Xcel(filename, "steel")
+        return timed(lambda: y.vit(2, names[-1], hs[-1]))
+
+    def firsts():
+        t = [first()]
+        while sum(t) < MINTIME and len(t) < 5:  # A full load for each run
+            t.append(first())
+        return min(t)
+
+    def write():
+        first = x.findtablerow(1, "FIRSTDATAROW")
+        for i in range(rows):
+            for j in range(NCOLUMNS):
+                x.cell(first+i, 6+j, float(i+j))
+
+    def writeonly():
+        w = Xcel(writeonly=True)
+        for i in range(rows):
+            w.w2row(i+1, 6, [float(i+j) for j in range(NCOLUMNS)])
+        w.savefile(os.path.join(folder, "writeonly%d.xlsx" % rows))
+
+    return [("calibration", lambda: min([timed(calibration) for k in range(FASTREPEAT)])),
+            ("cold_load", lambda: sampled(lambda: Xcel(filename, "steel"))),
+            ("cold_load_readonly", lambda: sampled(lambda: Xcel(filename, "steel", readonly=True).close())),
+            ("cold_load_compiled", lambda: sampled(lambda: Xcel(filename, "steel", compiled=True))),
+            ("first_lookup", firsts),
+            ("warm_vit", lambda: fast(lambda: [x.vit(2, s, hs[-1]) for s in names], len(names))),
+            ("warm_findtable", lambda: fast(lambda: [x.findtable(2) for s in names], len(names))),
+            ("warm_getrow", lambda: fast(lambda: [x.getrow(s) for s in names], len(names))),
+            ("bulk_rnvits", lambda: sampled(lambda: x.rnvits(2, names, hs))),
+            ("bulk_table_array", lambda: sampled(lambda: x.table_array(2))),
+            ("mdtable", lambda: sampled(lambda: x.mdtable(2, io.StringIO()))),
+            ("bulk_write", lambda: sampled(write)),
+            ("bulk_write_save_writeonly", lambda: sampled(writeonly)),
+            ("copyfile", lambda: sampled(lambda: copyfile(x, Xcel()))),
+            ("savefile", lambda: sampled(lambda: x.savefile(os.path.join(folder, "saved%d.xlsx" % rows))))]
+
+
+# Each round runs all the benchmarks of all the sizes once, and each
+# timing is the best of its rounds.  The runs of one benchmark are spread
+# over the whole session, so a busy spell of the machine does not slow
+# down all of them.
+def run(sizes, repeat):
+    folder = tempfile.mkdtemp(prefix="xcelbench")
+    try:
+        benches = [(str(rows), benchsize(folder, rows)) for rows in sizes]
+        results = {rows: {} for (rows, b) in benches}
+        for k in range(repeat):
+            for (rows, b) in benches:
+                for (name, timer) in b:
+                    gc.collect()
+                    t = timer()
+                    results[rows][name] = min(t, results[rows].get(name, t))
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    return {"python": platform.python_version(), "machine": platform.machine(),
+            "repeat": repeat, "results": results}
+
+
+# Print the results next to the baseline.  Returns the number of timings
+# that are more than "tolerance" times slower than the baseline.  The
+# ratios are of the timings divided by the calibration of their size and
+# run (the raw timings if the baseline has no calibration).
+def compare(current, baseline, tolerance):
+    slower = 0
+    print("%-6s %-26s %12s %12s %7s" % ("rows", "benchmark", "baseline", "current", "ratio"))
+    for (rows, r) in current["results"].items():
+        b = baseline["results"].get(rows, {})
+        scale = b["calibration"]/r["calibration"] if "calibration" in b else 1.0
+        for (name, t) in r.items():
+            if not name in b:
+                print("%-6s %-26s %12s %12.3e" % (rows, name, "-", t))
+                continue
+            ratio = t*scale/b[name] if b[name] > 0 else float("inf")
+            flag = ""
+            if name != "calibration" and ratio > tolerance:
+                flag = "  SLOWER"
+                slower += 1
+            print("%-6s %-26s %12.3e %12.3e %7.2f%s" % (rows, name, b[name], t, ratio, flag))
+    return slower
+
+
+def show(current):
+    print("%-6s %-26s %12s" % ("rows", "benchmark", "seconds"))
+    for (rows, r) in current["results"].items():
+        for (name, t) in r.items():
+            print("%-6s %-26s %12.3e" % (rows, name, t))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks of the Xcel lookup and write paths")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES, help="data rows per table")
+    parser.add_argument("--repeat", type=int, default=5, help="rounds")
+    parser.add_argument("--out", help="save the results to this JSON file")
+    parser.add_argument("--baseline", help="compare with this JSON file")
+    parser.add_argument("--save-baseline", action="store_true", help="save the results as %s" % BASELINE)
+    parser.add_argument("--tolerance", type=float, default=1.5)
+    args = parser.parse_args(argv)
+    current = run(args.sizes, args.repeat)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(current, f, indent=1)
+    if args.save_baseline:
+        with open(BASELINE, "w") as f:
+            json.dump(current, f, indent=1)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        return 1 if compare(current, baseline, args.tolerance) > 0 else 0
+    show(current)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
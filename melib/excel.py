@@ -12,10 +12,17 @@ from openpyxl.styles import Font, colors, Color
 from openpyxl.utils.cell import coordinate_from_string, column_index_from_string
 #
 import numpy as np
-from openpyxl.styles.borders import Border, Side
+from openpyxl.styles.borders import Border, Side, DEFAULT_BORDER
+from openpyxl.styles.fills import DEFAULT_EMPTY_FILL
 from openpyxl.drawing.image import Image
-from openpyxl.styles import Protection
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Protection, NamedStyle
+import itertools
+import re
 import sys
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 # from xt import thesame
 
 COLSKIP=0  # Empty columns on the left of the Mark column (default=0)
@@ -54,40 +61,165 @@ def similar(x, y, eps=0.001):
 # There should be a label in the second column of each row
 # No label means the end of the table
 def sametable(table_num, xf1, xf2, tablecol=0, skip={}):
-    irow=xf1.findtable(table_num)+1
-    while irow<xf1.maxrow():
-        if xf1.cell(irow,3+COLSKIP)==None:
-            return ""  # The table ended but no difference was observed
-        parname=xf1.cell(irow, 3)
-        if parname in skip.keys():
-            tol=skip[parname]            
-        else:
-            tol=0.001
-        v1=xf1.cell(irow, tablecol+6+COLSKIP)
-        v2=xf2.cell(irow, tablecol+6+COLSKIP)
-        cell=xf1.ws.cell(row=irow, column=tablecol+6+COLSKIP)
-        color_index=cell.fill.start_color.index
-        if type(color_index)==int:
-        # Protection against stupid Excel feature.  The colors selected from
-        # "theme colors" menu in Excel are integers. There is no color match
-        # between my "Excel theme color" indices and what openpyxl thinks they are.
-        # I think it is always a string when you pick the color from the color wheel
-        # Therefore, I will not accept integers and force selection from the wheel.
-            # import sys
-            # sys.exit("'%s'(%d,%d) : You must select from the color wheel not from 'standard colors'"%(cell.value,row,col))
-            colored=True
-        else:
-            colored=int(color_index,16)>0
+    d=tablediff(table_num, xf1, xf2, tablecol=tablecol, skip=skip)
+    if len(d)==0:
+        return ""  # The table ended but no difference was observed
+    irow=d[0]["row"]
+    s="\nirow=%d(%s:%s)MISMATCH "%(irow,xf1.cell(irow,5),xf2.cell(irow,5))
+    print(s)
+    print(d[0]["v1"], end="")
+    print(" and ", end="")
+    print(d[0]["v2"])
+    return s
+
+# Compares a table column of two files and returns all the mismatches as a
+# list of {"row", "label", "v1", "v2", "relerr", "tol"} dictionaries, in row
+# order.  The rules are the same as "sametable" and "similar": the colored
+# (input) cells of xf1 and the empty cells of xf2 are not compared, the
+# tolerance of a row is skip[label] (0.001 if the label is not in skip), and
+# values that are not numbers are taken as 0.  Each file is read in one
+# pass and the comparison is done on arrays.
+def tablediff(table_num, xf1, xf2, tablecol=0, skip={}):
+    ref=tablereference(table_num, xf1, tablecol=tablecol)
+    v2=readcolumn(xf2, ref["first"], len(ref["labels"]), ref["jcol"])
+    return comparecolumn(ref, v2, skip=skip)
+
+# The table column of the reference file that "tablediff" compares with
+def tablereference(table_num, xf1, tablecol=0):
+    jcol=tablecol+6+COLSKIP
+    first=xf1.findtable(table_num)+1
+    last=xf1.maxrow()-1
+    labels=[]
+    v1=[]
+    colored=[]
+    for row in xf1.ws.iter_rows(min_row=first, max_row=last, min_col=1,
+                                max_col=max(jcol, 3+COLSKIP), values_only=True):
+        if xf1.force(xf1.cellvalue(row[2+COLSKIP]))==None:
+            break
+        irow=first+len(labels)
+        labels.append(xf1.cell(irow, 3))
+        v1.append(xf1.force(xf1.cellvalue(row[jcol-1])))
+        colored.append(filled(xf1.ws.cell(row=irow, column=jcol)))
+    return {"first": first, "jcol": jcol, "labels": labels, "v1": v1, "colored": colored}
+
+# The values in rows first, first+1, ..., first+n-1 of column jcol
+def readcolumn(xf, first, n, jcol):
+    v=[]
+    if n>0:
+        for row in xf.ws.iter_rows(min_row=first, max_row=first+n-1, min_col=jcol,
+                                   max_col=jcol, values_only=True):
+            v.append(xf.force(xf.cellvalue(row[0])))
+    return v+[None]*(n-len(v))
+
+def comparecolumn(ref, v2, skip={}):
+    (labels, v1)=(ref["labels"], ref["v1"])
+    x=np.array([floatorzero(v) for v in v1])
+    y=np.array([floatorzero(v) for v in v2])
+    tol=np.array([skip[s] if s in skip.keys() else 0.001 for s in labels])
+    xysum=np.abs(x+y)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        relerr=np.where(xysum==0, np.abs(x), np.abs(x-y)/xysum)
+    bad=(relerr>tol) & ~np.array(ref["colored"], dtype=bool) & np.array([v!=None for v in v2], dtype=bool)
+    d=[]
+    for k in np.nonzero(bad)[0]:
+        d.append({"row": ref["first"]+int(k), "label": labels[k], "v1": v1[k], "v2": v2[k],
+                  "relerr": float(relerr[k]), "tol": float(tol[k])})
+    return d
+
+# BATCH COMPARISON
+# Compares the same table in many submitted files with one reference file.
+# The reference is read once.  The submissions are opened in read-only mode
+# (only the compared sheet is read) by a pool of "processes" worker
+# processes (all the cores by default; processes=1 does the work in this
+# process).  The reports are yielded as the files are done, not in the
+# order of "submissions":
+#     {"file", "mismatches", "seconds", "error"}
+# "mismatches" is the list "tablediff" returns; "error" is None or the reason
+# the file could not be compared.  Progress and a summary are printed
+# unless verbose=False.
+#
+#     for r in batchdiff(1, "answer.xlsx", glob.glob("submissions/*.xlsx")):
+#         if r["error"]==None and len(r["mismatches"])>0:
+#             print(r["file"], [m["label"] for m in r["mismatches"]])
+def batchdiff(table_num, reference, submissions, tablecol=0, skip={}, sheetname="",
+              processes=None, verbose=True):
+    t0=time.time()
+    if type(reference)==str:
+        reference=Xcel(reference, sheetname=sheetname)  # Full load: the fills are needed
+    ref=tablereference(table_num, reference, tablecol=tablecol)
+    jobs=[(f, ref, sheetname, skip) for f in submissions]
+    nfailed=0
+    nmismatched=0
+    if processes==1:
+        reports=map(diffsubmission, jobs)
+    else:
+        import multiprocessing
+        pool=multiprocessing.Pool(processes)
+        reports=pool.imap_unordered(diffsubmission, jobs)
+    try:
+        for k, r in enumerate(reports):
+            if r["error"]!=None:
+                nfailed+=1
+            elif len(r["mismatches"])>0:
+                nmismatched+=1
+            if verbose:
+                if r["error"]!=None:
+                    s="FAILED (%s)"%r["error"]
+                else:
+                    s="%d mismatches"%len(r["mismatches"])
+                print("[%d/%d] %s : %s (%.2f s)"%(k+1, len(jobs), r["file"], s, r["seconds"]))
+            yield r
+    finally:
+        if processes!=1:
+            pool.terminate()
+    if verbose:
+        print("%d files compared in %.2f s: %d with mismatches, %d failed"%
+              (len(jobs), time.time()-t0, nmismatched, nfailed))
 
-        if not colored and (not similar(v1,v2,eps=tol) and not v2==None):
-            s="\nirow=%d(%s:%s)MISMATCH "%(irow,xf1.cell(irow,5),xf2.cell(irow,5))
-            print(s)
-            print(v1, end="")
-            print(" and ", end="")
-            print(v2)
-            return s
-        irow+=1
-    return ""
+# Compares one submission for "batchdiff" (it runs in a worker process)
+def diffsubmission(job):
+    (filename, ref, sheetname, skip)=job
+    t0=time.time()
+    r={"file": filename, "mismatches": [], "error": None}
+    try:
+        import os
+        if not os.path.isfile(filename):
+            raise IOError("cannot be found")
+        xf2=Xcel(filename, sheetname=sheetname, readonly=True)
+        if xf2.filename()=="":
+            raise IOError("cannot be opened")
+        try:
+            v2=readcolumn(xf2, ref["first"], len(ref["labels"]), ref["jcol"])
+        finally:
+            xf2.close()  # The file stays open in read-only mode until then
+        r["mismatches"]=comparecolumn(ref, v2, skip=skip)
+    except Exception as e:
+        r["error"]="%s: %s"%(type(e).__name__, e)
+    r["seconds"]=time.time()-t0
+    return r
+
+def floatorzero(x):
+    try:
+        return float(x)
+    except:
+        return 0.0
+
+# True if the cell has a fill color (an input cell in the templates).  The
+# cells of grid sheets (see Gridsheet) have no fill.
+def filled(cell):
+    if not hasattr(cell, "fill"):
+        return False
+    color_index=cell.fill.start_color.index
+    if type(color_index)==int:
+    # Protection against stupid Excel feature.  The colors selected from
+    # "theme colors" menu in Excel are integers. There is no color match
+    # between my "Excel theme color" indices and what openpyxl thinks they are.
+    # I think it is always a string when you pick the color from the color wheel
+    # Therefore, I will not accept integers and force selection from the wheel.
+        # import sys
+        # sys.exit("'%s'(%d,%d) : You must select from the color wheel not from 'standard colors'"%(cell.value,row,col))
+        return True
+    return int(color_index,16)>0
 
 
 #colortable={"RED":colors.RED, "BLACK":colors.BLACK, "GREEN":colors.GREEN,
@@ -101,10 +233,827 @@ colortable={'RED': '00FF0000',
  'BLUE':'0000FF',
  'GRAY':'808080'}
 
+# STYLES
+# The fonts and alignments written by Xcel are shared.  There is one pair of
+# style objects for each (color, size, align) instead of one for each cell.
+STYLES={}
+def cellstyle(color="BLACK", size=None, align=None):
+    key=(color, size, align)
+    style=STYLES.get(key)
+    if style==None:
+        font=Font(color=None if color==None else colortable[color], size=size)
+        alignment=None if align==None else Alignment(horizontal=align)
+        style=STYLES[key]=(font, alignment)
+    return style
+
 def column_index(s):
     col = column_index_from_string(s)
     return col
 
+# The value of a cell as "Xcel.cell" returns it, but before "Xcel.force"
+# "ws" is the sheet where the "=A1" references are looked up
+def parsevalue(s, ws):
+    if type(s)==str:
+        if s[:1]=='\ufeff':  # This character sometimes creeps in for files coming from MAC
+            s=s[1:]
+        try:
+            z=float(s)
+        except:
+            z=s
+        s=z
+    # s=cello.value.replace(u'\ufeff', '', 1)
+    if type(s)==str:
+        if s=="":     return 0
+        if s[0]=='=':
+            try:
+                return ws[s[1:]].value
+            except:
+                return s  # Not a single cell reference (see Formulas)
+    return s
+
+# The sort key of a table value in "Xcel.query": the numbers, then the
+# strings, then the other values
+def orderkey(z):
+    if type(z) in (int, float) and z==z:
+        return (0, z)
+    if type(z)==str:
+        return (1, z)
+    return (2, 0)
+
+# GRID SHEETS
+# A Gridsheet keeps only the cell values of a worksheet as a list of row
+# tuples.  It has the part of the openpyxl worksheet interface that the
+# Xcel read methods use (cell, rows, iter_rows, max_row, ...), so an Xcel
+# can read from it exactly as it reads from a workbook.  There are no
+# styles, so an Xcel with grid sheets is read-only.
+class Gridcell:
+    __slots__=("value",)
+    def __init__(self, value=None):
+        self.value=value
+
+class Gridsheet:
+    def __init__(self, title, values, max_column=0):
+        self.title=title
+        self.values=values  # values[i-1][j-1] is the value in row i, column j
+        self.max_row=len(values)
+        self.max_column=max_column
+
+    def value(self, row, column):
+        if row<1 or row>self.max_row:
+            return None
+        r=self.values[row-1]
+        if column<1 or column>len(r):
+            return None
+        return r[column-1]
+
+    def cell(self, row, column):
+        return Gridcell(self.value(row, column))
+
+    def __getitem__(self, coordinate):
+        (c, row)=coordinate_from_string(coordinate)
+        return self.cell(row, column_index_from_string(c))
+
+    def iter_rows(self, min_row=None, max_row=None, min_col=None, max_col=None, values_only=False):
+        min_row=1 if min_row==None else min_row
+        max_row=self.max_row if max_row==None else max_row
+        min_col=1 if min_col==None else min_col
+        max_col=self.max_column if max_col==None else max_col
+        for i in range(min_row, max_row+1):
+            row=tuple(self.value(i, j) for j in range(min_col, max_col+1))
+            if values_only:
+                yield row
+            else:
+                yield tuple(Gridcell(v) for v in row)
+
+    @property
+    def rows(self):
+        return self.iter_rows()
+
+class Gridbook:
+    def __init__(self, sheets, active=0):
+        self.worksheets=sheets
+        self.active=sheets[active] if len(sheets)>0 else None
+
+    @property
+    def sheetnames(self):
+        return [ws.title for ws in self.worksheets]
+
+    def __getitem__(self, sheetname):
+        for ws in self.worksheets:
+            if ws.title==sheetname:
+                return ws
+        raise KeyError("Worksheet %s does not exist."%sheetname)
+
+# A Gridbook over a workbook opened with openpyxl in read-only mode.  A sheet
+# is copied into a Gridsheet the first time it is selected; the sheets that
+# are never selected are never read.  The file is closed once every sheet
+# has been read (or by "close").
+class Streambook(Gridbook):
+    def __init__(self, wb):
+        self.source=wb
+        self.sheets={}
+
+    @property
+    def sheetnames(self):
+        return self.source.sheetnames
+
+    @property
+    def active(self):
+        return self[self.source.active.title]
+
+    @property
+    def worksheets(self):
+        return [self[sheetname] for sheetname in self.sheetnames]
+
+    def __getitem__(self, sheetname):
+        ws=self.sheets.get(sheetname)
+        if ws==None:
+            ws=gridsheet(self.source[sheetname])
+            self.sheets[sheetname]=ws
+            if len(self.sheets)==len(self.source.sheetnames):
+                self.close()
+        return ws
+
+    def close(self):
+        self.source.close()
+
+# Copy the values of an openpyxl worksheet into a Gridsheet.  The values
+# are kept raw, as openpyxl reads them, so that "Xcel.cell" parses them and
+# the label lookups compare them exactly as for the workbook (a label such
+# as "+2.5" stays a string).  The trailing empty cells of each row are dropped.
+def gridsheet(ws):
+    values=[]
+    max_column=0
+    for r in ws.iter_rows(values_only=True):
+        max_column=max(max_column, len(r))
+        r=list(r)
+        while len(r)>0 and r[-1]==None:
+            r.pop()
+        values.append(tuple(r))
+    return Gridsheet(ws.title, values, max_column)
+
+# COMPILED WORKBOOKS
+# "compilefile" saves the cell values and the table indexes of a workbook
+# into a cache file.  Loading the cache is much quicker than parsing the
+# workbook with openpyxl.  The cache is keyed on the size, the modification
+# time and the content hash of the workbook.  It is rebuilt when the
+# workbook changes.  The caches are pickles, and loading a pickle can run
+# code, so they are only read from places that the user or the package
+# writes: "__xlcache__" in the package data folder for the data files, and
+# "~/.cache/melib" for the other workbooks (or if the data folder cannot be
+# written).  A "__xlcache__" folder next to any other workbook is ignored.
+CACHEVERSION=2  # 2: raw values (see gridsheet)
+
+def cachefilenames(filename):
+    import os, hashlib
+    filename=os.path.realpath(filename)
+    (folder, name)=os.path.split(filename)
+    tag=hashlib.sha1(filename.encode()).hexdigest()[:12]
+    usercache=os.path.join(os.path.expanduser("~"), ".cache", "melib", "%s-%s.pickle"%(name, tag))
+    if folder!=os.path.join(os.path.dirname(os.path.realpath(__file__)), "data"):
+        return [usercache]
+    return [os.path.join(folder, "__xlcache__", name+".pickle"), usercache]
+
+def filehash(filename):
+    import hashlib
+    with open(filename, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def writecache(cache):
+    import os, pickle
+    for cachefile in cachefilenames(cache["source"]):
+        try:
+            os.makedirs(os.path.dirname(cachefile), exist_ok=True)
+            tmpfile="%s.%d.tmp"%(cachefile, os.getpid())
+            with open(tmpfile, "wb") as f:
+                pickle.dump(cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmpfile, cachefile)  # Other processes never see half a file
+            return cachefile
+        except OSError:
+            continue
+    return None
+
+def compilefile(filename, data_only=True):
+    """ Compiles the Excel file into a cache file and returns the cache.
+    ``Xcel(filename, compiled=True)`` will read the cache instead of the workbook
+    for as long as the workbook is unchanged.
+    """
+    import os
+    st=os.stat(filename)
+    wb=load_workbook(filename=filename, data_only=data_only)
+    book=Gridbook([gridsheet(ws) for ws in wb.worksheets], wb.index(wb.active))
+    x=Xcel()
+    x.wb=book
+    index={}
+    for ws in book.worksheets:
+        x.ws=ws
+        for t in x.sheetindex():
+            x.tablecolumns(t)
+        index[ws.title]=x.sheetindex()
+    cache={"version": CACHEVERSION, "source": os.path.realpath(filename),
+           "data_only": data_only, "size": st.st_size, "mtime": st.st_mtime_ns,
+           "hash": filehash(filename), "book": book, "index": index}
+    writecache(cache)
+    return cache
+
+# Returns the cache of the Excel file if there is a valid one, otherwise None
+def loadcompiled(filename, data_only=True):
+    import os, pickle
+    st=os.stat(filename)
+    for cachefile in cachefilenames(filename):
+        try:
+            with open(cachefile, "rb") as f:
+                cache=pickle.load(f)
+        except Exception:
+            continue
+        if cache.get("version")!=CACHEVERSION or cache["data_only"]!=data_only:
+            continue
+        if cache["size"]!=st.st_size:
+            continue
+        if cache["mtime"]!=st.st_mtime_ns:
+            if cache["hash"]!=filehash(filename):
+                continue
+            cache["mtime"]=st.st_mtime_ns  # Touched but not changed
+            writecache(cache)
+        return cache
+    return None
+
+# SHARED WORKBOOKS
+# "Sharedfile" publishes the compiled cell values of a workbook (see
+# compilefile) once into a block of shared memory, so that the worker
+# processes of a multiprocessing pool can read the workbook without opening
+# or unpickling it.  The numbers of all the sheets are kept in one float64
+# array; a second int8 array tells the kind of each cell (see SHAREDKINDS).
+# The strings and the other values are kept in a small dictionary that
+# travels with the handle, with the table indexes.  A worker attaches to the
+# handle with "Xcel.openshared" (or "Sharedfile.xcel"); the sheets read the
+# shared arrays in place and are read-only.
+#
+#   >>> sf=Sharedfile("mats.xlsx")
+#   >>> pool=Pool(initializer=worker_init, initargs=(sf.handle,))
+#   ...     x=Xcel(); x.openshared(handle, "steel")  # in worker_init
+#   >>> sf.close()  # When the workers are done
+SHAREDKINDS=(None, float, int, bool)  # Kind 0 is an empty cell, the others are in "text"
+
+class Sharedsheet(Gridsheet):
+    def __init__(self, title, numbers, kinds, text, max_column=0):
+        self.title=title
+        self.numbers=numbers
+        self.kinds=kinds
+        self.text=text  # {(row, column): value} for the cells that are not numbers
+        self.max_row=kinds.shape[0]
+        self.max_column=max_column
+
+    def value(self, row, column):
+        if row<1 or row>self.max_row or column<1 or column>self.kinds.shape[1]:
+            return None
+        k=self.kinds[row-1, column-1]
+        if k==0:
+            return None
+        if k<len(SHAREDKINDS):
+            return SHAREDKINDS[k](self.numbers[row-1, column-1])
+        return self.text[(row, column)]
+
+# Split a Gridsheet into the number and kind arrays of shared memory
+def sharedsheet(ws, numbers, kinds):
+    text={}
+    for (i, r) in enumerate(ws.values):
+        for (j, v) in enumerate(r):
+            t=type(v)
+            if v==None:
+                continue
+            if t in SHAREDKINDS and (t!=int or abs(v)<2**53):
+                kinds[i, j]=SHAREDKINDS.index(t)
+                numbers[i, j]=v
+            else:
+                kinds[i, j]=len(SHAREDKINDS)
+                text[(i+1, j+1)]=v
+    return text
+
+# Attach to the shared memory block "name" without registering it with the
+# resource tracker of this process: the block belongs to the publisher.
+def attachshared(name):
+    from multiprocessing import shared_memory
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:  # Python < 3.13
+        return shared_memory.SharedMemory(name=name)
+
+class Sharedfile:
+    def __init__(self, filename, data_only=True):
+        from multiprocessing import shared_memory
+        cache=loadcompiled(filename, data_only=data_only)
+        if cache==None:
+            cache=compilefile(filename, data_only=data_only)
+        book=cache["book"]
+        shapes=[(ws.max_row, ws.max_column) for ws in book.worksheets]
+        size=sum([9*r*c for (r, c) in shapes])  # 8 bytes of number and 1 byte of kind per cell
+        self.shm=shared_memory.SharedMemory(create=True, size=max(size, 1))
+        sheets=[]
+        offset=0
+        for (ws, (r, c)) in zip(book.worksheets, shapes):
+            numbers=np.ndarray((r, c), dtype=np.float64, buffer=self.shm.buf, offset=offset)
+            kinds=np.ndarray((r, c), dtype=np.int8, buffer=self.shm.buf, offset=offset+8*r*c)
+            numbers[:]=0.0
+            kinds[:]=0
+            text=sharedsheet(ws, numbers, kinds)
+            sheets.append({"title": ws.title, "offset": offset, "shape": (r, c), "text": text})
+            offset+=9*r*c
+        del numbers, kinds  # The block cannot be closed while arrays point into it
+        self.handle={"name": self.shm.name, "source": cache["source"],
+                     "active": book.worksheets.index(book.active), "sheets": sheets,
+                     "index": cache["index"]}
+
+    # An Xcel reading this process's copy of the shared workbook
+    def xcel(self, sheetname=""):
+        x=Xcel()
+        x.openshared(self.handle, sheetname)
+        return x
+
+    # Release the shared memory block.  The workers must be done with it.
+    def close(self):
+        if self.shm!=None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm=None
+
+# The Gridbook of a shared workbook, attached to the shared memory block
+def sharedbook(handle):
+    shm=attachshared(handle["name"])
+    sheets=[]
+    for d in handle["sheets"]:
+        (r, c)=d["shape"]
+        numbers=np.ndarray((r, c), dtype=np.float64, buffer=shm.buf, offset=d["offset"])
+        kinds=np.ndarray((r, c), dtype=np.int8, buffer=shm.buf, offset=d["offset"]+8*r*c)
+        numbers.flags.writeable=False
+        kinds.flags.writeable=False
+        sheets.append(Sharedsheet(d["title"], numbers, kinds, d["text"], c))
+    book=Gridbook(sheets, handle["active"])
+    book.shm=shm  # Keeps the block mapped for as long as the book is used
+    return book
+
+# FORMULAS
+# Formulas evaluates the formulas of a worksheet in-process, without Excel.
+# It is used by Xcel.cell when "evaluate" is on (see Xcel.evaluate).  The
+# supported subset is:
+#   numbers, "strings", TRUE, FALSE
+#   cell references (A1, $A$1) and ranges (A1:C4) on the same sheet
+#   + - * / ^ % & = <> < > <= >= and parentheses
+#   SUM, MIN, MAX, IF, INDEX, MATCH
+# Each formula is parsed once.  The cells it refers to are recorded in a
+# dependency graph so that a change in a cell (see "changed") only drops
+# the values of the formulas downstream of that cell.  The values are
+# evaluated when they are first read and are kept until then.
+# The errors are returned as Xlerror values, e.g. Xlerror("#DIV/0!"), or
+# Xlerror("#NUM!") for a power that is complex or too large.
+
+class Xlerror(str):
+    pass
+
+class Formulaerror(Exception):
+    def __init__(self, code):
+        Exception.__init__(self, code)
+        self.code=code
+
+FORMULATOKENS=re.compile(r'''\s*(?:
+ (?P<func>[A-Za-z][A-Za-z0-9.]*)\s*\(
+|(?P<range>\$?[A-Za-z]{1,3}\$?[0-9]+:\$?[A-Za-z]{1,3}\$?[0-9]+)
+|(?P<ref>\$?[A-Za-z]{1,3}\$?[0-9]+)
+|(?P<bool>TRUE|FALSE)\b
+|(?P<num>[0-9]+\.?[0-9]*(?:[eE][-+]?[0-9]+)?|\.[0-9]+(?:[eE][-+]?[0-9]+)?)
+|(?P<str>"(?:[^"]|"")*")
+|(?P<op><>|<=|>=|[-+*/^&=<>(),%])
+)''', re.X)
+
+def formulatokens(formula):
+    tokens=[]
+    k=0
+    formula=formula.rstrip()
+    while k<len(formula):
+        m=FORMULATOKENS.match(formula, k)
+        if m==None:
+            raise Formulaerror("#NAME?")
+        kind=m.lastgroup
+        tokens.append((kind, m.group(kind)))
+        k=m.end()
+    tokens.append(("end", None))
+    return tokens
+
+def cellref(s):
+    (c, row)=coordinate_from_string(s.replace("$", "").upper())
+    return (row, column_index_from_string(c))
+
+# Parses the formula (without the "=") into a tree of tuples
+class Formulaparser:
+    COMPARE=("=", "<>", "<", ">", "<=", ">=")
+    def __init__(self, formula):
+        self.tokens=formulatokens(formula)
+        self.k=0
+
+    def peek(self):
+        return self.tokens[self.k]
+
+    def take(self, op=None):
+        t=self.tokens[self.k]
+        if op!=None and t!=("op", op):
+            raise Formulaerror("#NAME?")
+        self.k+=1
+        return t
+
+    def parse(self):
+        tree=self.comparison()
+        if self.peek()[0]!="end":
+            raise Formulaerror("#NAME?")
+        return tree
+
+    def comparison(self):
+        a=self.concat()
+        while self.peek()[0]=="op" and self.peek()[1] in self.COMPARE:
+            op=self.take()[1]
+            a=("op", op, a, self.concat())
+        return a
+
+    def concat(self):
+        a=self.additive()
+        while self.peek()==("op", "&"):
+            self.take()
+            a=("op", "&", a, self.additive())
+        return a
+
+    def additive(self):
+        a=self.multiplicative()
+        while self.peek() in (("op", "+"), ("op", "-")):
+            op=self.take()[1]
+            a=("op", op, a, self.multiplicative())
+        return a
+
+    def multiplicative(self):
+        a=self.power()
+        while self.peek() in (("op", "*"), ("op", "/")):
+            op=self.take()[1]
+            a=("op", op, a, self.power())
+        return a
+
+    def power(self):
+        a=self.unary()
+        while self.peek()==("op", "^"):
+            self.take()
+            a=("op", "^", a, self.unary())
+        return a
+
+    def unary(self):  # In Excel, -2^2 is 4
+        if self.peek()==("op", "-"):
+            self.take()
+            return ("neg", self.unary())
+        if self.peek()==("op", "+"):
+            self.take()
+            return self.unary()
+        return self.percent()
+
+    def percent(self):
+        a=self.primary()
+        while self.peek()==("op", "%"):
+            self.take()
+            a=("op", "/", a, ("num", 100.0))
+        return a
+
+    def primary(self):
+        (kind, s)=self.take()
+        if kind=="num":
+            return ("num", float(s))
+        if kind=="str":
+            return ("str", s[1:-1].replace('""', '"'))
+        if kind=="bool":
+            return ("bool", s=="TRUE")
+        if kind=="ref":
+            return ("ref",)+cellref(s)
+        if kind=="range":
+            (a, b)=s.split(":")
+            (r1, c1)=cellref(a)
+            (r2, c2)=cellref(b)
+            return ("range", min(r1, r2), min(c1, c2), max(r1, r2), max(c1, c2))
+        if kind=="func":
+            args=[]
+            if self.peek()!=("op", ")"):
+                args.append(self.comparison())
+                while self.peek()==("op", ","):
+                    self.take()
+                    args.append(self.comparison())
+            self.take(")")
+            return ("func", s.upper(), args)
+        if (kind, s)==("op", "("):
+            a=self.comparison()
+            self.take(")")
+            return a
+        raise Formulaerror("#NAME?")
+
+# The cells a formula tree refers to
+def formulacells(tree, cells):
+    if tree[0]=="ref":
+        cells.add((tree[1], tree[2]))
+    elif tree[0]=="range":
+        for i in range(tree[1], tree[3]+1):
+            for j in range(tree[2], tree[4]+1):
+                cells.add((i, j))
+    elif tree[0]=="op":
+        formulacells(tree[2], cells)
+        formulacells(tree[3], cells)
+    elif tree[0]=="neg":
+        formulacells(tree[1], cells)
+    elif tree[0]=="func":
+        for a in tree[2]:
+            formulacells(a, cells)
+    return cells
+
+def xlnumber(v):
+    if type(v)==bool:
+        return float(v)
+    if v==None:
+        return 0
+    if type(v) in (int, float):
+        return v
+    try:
+        return float(v)
+    except:
+        raise Formulaerror("#VALUE!")
+
+def xltext(v):
+    if v==None:
+        return ""
+    if type(v)==bool:
+        return "TRUE" if v else "FALSE"
+    if type(v)==float:
+        return "%.15g"%v
+    return str(v)
+
+def xltrue(v):
+    if type(v)==str:
+        if v.upper() in ("TRUE", "FALSE"):
+            return v.upper()=="TRUE"
+        raise Formulaerror("#VALUE!")
+    return xlnumber(v)!=0
+
+# Excel ordering: numbers < text < logical values.  Text is not case sensitive.
+def xlkey(v):
+    if v==None:
+        return (0, 0)
+    if type(v)==bool:
+        return (2, v)
+    if type(v)==str:
+        return (1, v.lower())
+    return (0, v)
+
+class Formulas:
+    def __init__(self, ws):
+        self.ws=ws
+        self.values={}  # (row, column): value of the formula
+        self.trees={}   # (row, column): parsed formula
+        self.deps={}    # (row, column): the cells the formula refers to
+        self.users={}   # (row, column): the formulas that refer to the cell
+        self.busy=set() # The formulas being evaluated (to catch circular references)
+
+    # The value of a cell.  A formula is evaluated if its value is not known.
+    def value(self, row, column):
+        key=(row, column)
+        if key in self.values:
+            return self.values[key]
+        raw=self.ws.cell(row=row, column=column).value
+        if not (type(raw)==str and raw[:1]=="="):
+            return parsevalue(raw, self.ws)
+        if key in self.busy:
+            return Xlerror("#REF!")  # Circular reference
+        self.busy.add(key)
+        try:
+            tree=self.trees.get(key)
+            if tree==None:
+                tree=self.compile(key, raw[1:])
+            v=self.evaluate(tree)
+            if type(v)==list:
+                v=v[0][0] if len(v)==1 and len(v[0])==1 else Xlerror("#VALUE!")
+            if v==None:
+                v=0
+        except Formulaerror as e:
+            v=Xlerror(e.code)
+        except ZeroDivisionError:
+            v=Xlerror("#DIV/0!")
+        except OverflowError:
+            v=Xlerror("#NUM!")
+        finally:
+            self.busy.discard(key)
+        self.values[key]=v
+        return v
+
+    def compile(self, key, formula):
+        tree=("err", "#NAME?")
+        try:
+            tree=Formulaparser(formula).parse()
+        finally:
+            self.trees[key]=tree
+            self.deps[key]=formulacells(tree, set())
+            for cell in self.deps[key]:
+                self.users.setdefault(cell, set()).add(key)
+        return tree
+
+    # The cell at (row, column) has changed.  Forget its formula and the
+    # values of all the formulas downstream of it.
+    def changed(self, row, column):
+        key=(row, column)
+        self.trees.pop(key, None)
+        for cell in self.deps.pop(key, ()):
+            self.users.get(cell, set()).discard(key)
+        stack=[key]
+        done=set()
+        while len(stack)>0:
+            k=stack.pop()
+            if k in done:
+                continue
+            done.add(k)
+            self.values.pop(k, None)
+            stack.extend(self.users.get(k, ()))
+
+    def operand(self, tree):
+        v=self.evaluate(tree)
+        if type(v)==list:
+            raise Formulaerror("#VALUE!")
+        if isinstance(v, Xlerror):
+            raise Formulaerror(v)
+        return v
+
+    def evaluate(self, tree):
+        kind=tree[0]
+        if kind in ("num", "str", "bool"):
+            return tree[1]
+        if kind=="err":
+            raise Formulaerror(tree[1])
+        if kind=="ref":
+            return self.value(tree[1], tree[2])
+        if kind=="range":
+            return [[self.value(i, j) for j in range(tree[2], tree[4]+1)]
+                    for i in range(tree[1], tree[3]+1)]
+        if kind=="neg":
+            return -xlnumber(self.operand(tree[1]))
+        if kind=="op":
+            op=tree[1]
+            a=self.operand(tree[2])
+            b=self.operand(tree[3])
+            if op=="&":
+                return xltext(a)+xltext(b)
+            if op in Formulaparser.COMPARE:
+                (a, b)=(xlkey(a), xlkey(b))
+                return {"=": a==b, "<>": a!=b, "<": a<b, ">": a>b, "<=": a<=b, ">=": a>=b}[op]
+            (a, b)=(xlnumber(a), xlnumber(b))
+            if op=="+": return a+b
+            if op=="-": return a-b
+            if op=="*": return a*b
+            if op=="/": return a/b
+            if op=="^":
+                v=float(a)**b
+                if type(v)==complex:  # A negative number to a fractional power
+                    raise Formulaerror("#NUM!")
+                return v
+        if kind=="func":
+            f=getattr(self, "f"+tree[1], None)
+            if f==None:
+                raise Formulaerror("#NAME?")
+            return f(tree[2])
+        raise Formulaerror("#VALUE!")
+
+    # The numbers in the arguments of SUM, MIN and MAX.  Text and empty
+    # cells in ranges are skipped, as in Excel.
+    def numbers(self, args):
+        x=[]
+        for a in args:
+            v=self.evaluate(a)
+            if type(v)==list:
+                for row in v:
+                    for z in row:
+                        if isinstance(z, Xlerror):
+                            raise Formulaerror(z)
+                        if type(z) in (int, float):
+                            x.append(z)
+            else:
+                if isinstance(v, Xlerror):
+                    raise Formulaerror(v)
+                x.append(xlnumber(v))
+        return x
+
+    def fSUM(self, args):
+        return sum(self.numbers(args))
+
+    def fMIN(self, args):
+        x=self.numbers(args)
+        return min(x) if len(x)>0 else 0
+
+    def fMAX(self, args):
+        x=self.numbers(args)
+        return max(x) if len(x)>0 else 0
+
+    def fIF(self, args):
+        if len(args)<2 or len(args)>3:
+            raise Formulaerror("#VALUE!")
+        if xltrue(self.operand(args[0])):
+            return self.evaluate(args[1])
+        if len(args)==3:
+            return self.evaluate(args[2])
+        return False
+
+    def fINDEX(self, args):
+        if len(args)<2 or len(args)>3:
+            raise Formulaerror("#VALUE!")
+        a=self.evaluate(args[0])
+        if type(a)!=list:
+            a=[[a]]
+        i=int(xlnumber(self.operand(args[1])))
+        j=int(xlnumber(self.operand(args[2]))) if len(args)==3 else 0
+        if len(args)==2 and len(a)==1:  # A single row: the index is the column
+            (i, j)=(1, i)
+        if j==0 and len(a[0])==1:
+            j=1
+        if i<1 or i>len(a) or j<1 or j>len(a[0]):
+            raise Formulaerror("#REF!")
+        return a[i-1][j-1]
+
+    def fMATCH(self, args):
+        if len(args)<2 or len(args)>3:
+            raise Formulaerror("#VALUE!")
+        x=xlkey(self.operand(args[0]))
+        a=self.evaluate(args[1])
+        if type(a)!=list:
+            a=[[a]]
+        if len(a)>1 and len(a[0])>1:
+            raise Formulaerror("#N/A")
+        a=[z for row in a for z in row]
+        how=int(xlnumber(self.operand(args[2]))) if len(args)==3 else 1
+        found=0
+        for k, z in enumerate(a):
+            if z==None:
+                continue
+            z=xlkey(z)
+            if how==0:
+                if z==x:
+                    return k+1
+            elif how>0:
+                if z[0]==x[0] and z<=x:
+                    found=k+1
+                elif z[0]==x[0]:
+                    break
+            else:
+                if z[0]==x[0] and z>=x:
+                    found=k+1
+                elif z[0]==x[0]:
+                    break
+        if found==0:
+            raise Formulaerror("#N/A")
+        return found
+
+# TRACING
+# With "Xcel.Trace" on (for all the Xcels, or per Xcel with "trace"), the
+# Xcel counts what it does, in its own "counters" and in the global COUNTERS:
+#   opens, openseconds   workbooks opened and the seconds it took
+#   sheets               sheet switches (see sheet)
+#   rowsscanned          rows read to build the table and label indexes,
+#                        i.e. the scans behind findtable, getrow, vit, ...
+#   reads, writes        cell reads and writes (see cell)
+#   cachehits, cachemisses  cell reads from/not from the value cache
+# Nothing is counted when Trace is off.
+#
+#   >>> with tracing() as counts:
+#   ...     design()
+#   >>> counts
+#   {'opens': 2, 'openseconds': 0.004, 'rowsscanned': 612, 'reads': 40, ...}
+COUNTERS={}
+
+# A copy of the global counters
+def xcelcounts():
+    return dict(COUNTERS)
+
+def resetcounts():
+    COUNTERS.clear()
+
+# Turn Trace on in the "with" block, for Xcel "x" or for all the Xcels.  The
+# dictionary it returns is filled at the end with the counts of the block.
+# For a Sheetview, Trace is turned on for its Xcel (see Sheetview).
+@contextmanager
+def tracing(x=None):
+    if isinstance(x, Sheetview):
+        x=x.parent
+    owner=Xcel if x==None else x
+    counters=COUNTERS if x==None else x.counters
+    before=dict(counters)
+    trace=owner.__dict__.get("Trace")
+    owner.Trace=True
+    counts={}
+    try:
+        yield counts
+    finally:
+        if trace==None:
+            del owner.Trace
+        else:
+            owner.Trace=trace
+        for (name, n) in counters.items():
+            if n!=before.get(name, 0):
+                counts[name]=n-before.get(name, 0)
+
 # data_only: This is a confusing parameter.  You can either have the
 # formula or the cached value of the last evaluation. If you alter a file
 # with formulae then you must pass it through some kind of application such
@@ -118,17 +1067,53 @@ class Xcel:
     lastrow=0
     Debug=False
     Xcelfilename=""
-    def __init__(self, filename=None, sheetname="", data_only=True):
+    readonly=False
+    writeonly=False
+    Evaluate=False
+    Trace=False
+    # compiled=True reads the values from the compiled cache of the file (see
+    # compilefile).  The cache is built if there is not one or if the file
+    # has changed since.  This Xcel will be read-only.  The caches of the
+    # workbooks outside the package data folder are kept in ~/.cache/melib
+    # (see cachefilenames), never next to the workbook.
+    # readonly=True streams the file with the openpyxl read-only mode and
+    # keeps only the values of the sheets that are selected (see Streambook).
+    # It takes much less time and memory than a full load if only a few of
+    # the sheets are used.
+    # writeonly=True creates a new workbook that is written to the disk as
+    # the rows are added with "w2row" or "cell" (see appendrow).  Use it for
+    # large reports.  The rows must be written in order and cannot be read.
+    def __init__(self, filename=None, sheetname="", data_only=True, compiled=False, readonly=False,
+                 writeonly=False):
         import os
         self.fdic={}  # Just in case I want to add a dictionary of funcs
-        if filename==None:
+        self.tindex={}  # Table indexes, one per worksheet (see tableindex)
+        self.lindex={}  # Label indexes, one per worksheet (see labelindex)
+        self.vcache={}  # Parsed cell values, one dictionary per worksheet (see cell)
+        self.cachehits=0
+        self.cachemisses=0
+        self.fcalc={}  # Formula evaluators, one per worksheet (see evaluate)
+        self.qindex={}  # Sorted table columns, one dictionary per worksheet (see query)
+        self.windex=None  # The rows of the table labels of the workbook (see rowindex)
+        self.counters={}  # See tracing
+        self.views={}  # Sheet views (see view)
+        self.dvrules={}  # Data validations to write, one dictionary per worksheet (see validate)
+        self.dvwritten={}
+        if filename==None and writeonly:
+            self.wb=Workbook(write_only=True)
+            self.ws=self.wb.create_sheet(title=sheetname if sheetname!="" else "data")
+            self.writeonly=True
+        elif filename==None:
             self.wb=Workbook()
             self.ws=self.wb.active
             if sheetname=="":
                 sheetname="data"
             self.ws.title=sheetname
         elif os.path.isfile(filename):
-            if (self.openfile(filename, sheetname, data_only=data_only)):
+            if compiled:
+                self.opencompiled(filename, sheetname, data_only=data_only)
+                self.Xcelfilename=filename
+            elif (self.openfile(filename, sheetname, data_only=data_only, readonly=readonly)):
                 self.Xcelfilename=filename
             else:
                 self.Xcelfilename=""
@@ -141,32 +1126,64 @@ class Xcel:
         return self.Xcelfilename
 
     def newsheet(self, sheetname):
+        self.writable()
         self.ws=self.wb.create_sheet(title=sheetname)
 
     def sheet(self, sheetname=None):
         if not sheetname==None:
             try:
-                self.ws=self.wb[sheetname]
+                ws=self.wb[sheetname]
             except:
                 return None
+            if self.Trace and not ws is self.ws:
+                self.count("sheets")
+            self.ws=ws
         return self.ws.title
 
     def debug(self, debug=True):
         self.Debug=debug
 
+    # Count the work of this Xcel (see tracing)
+    def trace(self, trace=True):
+        self.Trace=trace
+
+    def count(self, name, n=1):
+        self.counters[name]=self.counters.get(name, 0)+n
+        COUNTERS[name]=COUNTERS.get(name, 0)+n
+
+    # A copy of the counters of this Xcel
+    def counts(self):
+        return dict(self.counters)
+
+    # Evaluate the formulas in "cell" instead of returning them as strings.
+    # Use this for workbooks opened with data_only=False or written by
+    # openpyxl.  The values are updated when an input changes through "cell".
+    def evaluate(self, evaluate=True):
+        self.Evaluate=evaluate
+
+    # The formula evaluator of the current sheet
+    def formulas(self):
+        f=self.fcalc.get(self.ws)
+        if f==None:
+            f=self.fcalc[self.ws]=Formulas(self.ws)
+        return f
+
     def protect(self, password):
 #        self.ws.protection.set_password(password)
 #        self.ws.protection.SheetProtection(insertRows=False, password=password)
+        self.writable()
         self.ws.protection.enable()
         self.ws.protection.password=password
 # SOURCE = https://openpyxl.readthedocs.io/en/stable/api/openpyxl.worksheet.protection.html
 
     def cellprotect(self, row, column, protect):
+        self.writable()
         cello=self.ws.cell(row=row, column=column)
         cello.protection=Protection(locked=protect, hidden=False)
 
     # Column Width, can be called by c="D" or c=4
     def columnw(self,c,w):
+        self.writable()
         if type(c)==int:
             c=chr(ord('A')+c-1)
         self.ws.column_dimensions[c].width=w
@@ -176,13 +1193,7 @@ class Xcel:
     def maxrow(self):
         return self.ws.max_row
     def getrow(self, rowname):
-        ws=self.ws
-        k=0
-        for row in ws.rows:
-            k+=1
-            if len(row)>3 and rowname==row[2].value:
-                return k
-        return None
+        return self.findrow(rowname)
     def vir(self, rowname, col=6, value=None, sheet=None):  # vir: valueinrow
         self.sheet(sheetname=sheet)
         row=self.getrow(rowname)
@@ -201,47 +1212,215 @@ class Xcel:
         for rowname in rownames:
             v.append(self.vir(rowname))
         return v
+    # All the labelled parameters of the sheet, read in one pass:
+    # {rowname: value in column "col"}.  The first row wins if a label is
+    # repeated, as in "vir".  The formulas and the references are read
+    # through "cell", so the values are always those of "vir".
+    def params_dict(self, col=6, sheet=None):
+        self.sheet(sheetname=sheet)
+        d={}
+        if self.ws.max_column<4:
+            return d
+        for (k, row) in enumerate(self.ws.iter_rows(min_col=3, max_col=max(col, 3), values_only=True), 1):
+            if row[0]!=None and not row[0] in d:
+                if col<3:
+                    d[row[0]]=None
+                elif type(row[col-3])==str and "=" in row[col-3][:2]:
+                    d[row[0]]=self.cell(k, col)
+                else:
+                    d[row[0]]=self.force(self.cellvalue(row[col-3]))
+        if col<3:  # The value is on the left of the label
+            for rowname in d:
+                d[rowname]=self.vir(rowname, col)
+        return d
+    # "column" counts from 0, so the default (2) is column C
     def findrow(self, rowname, column=2):
-        k=0
-        for row in self.ws.rows:
-            k+=1
-            if len(row)>3 and rowname==row[column].value:
-                return k
-        return None
+        return self.labelindex(column).get(rowname)
+    # The label index of the current sheet: {value: first row} for the
+    # values in "column" (counting from 0).  It is built with one pass over
+    # the sheet and is kept up to date by the writes through "cell".
+    def labelindex(self, column=2):
+        index=self.lindex.get(self.ws)
+        if index==None:
+            index=self.lindex[self.ws]={}
+        labels=index.get(column)
+        if labels==None:
+            if self.ws.max_column<4:  # No labels yet; not cached, the sheet may grow
+                return {}
+            labels={}
+            k=0
+            for row in self.ws.iter_rows(min_col=column+1, max_col=column+1, values_only=True):
+                k+=1
+                if row[0]!=None and not row[0] in labels:
+                    labels[row[0]]=k
+            index[column]=labels  # Only complete indexes are seen by the other views
+            if self.Trace:
+                self.count("rowsscanned", k)
+        return labels
     def rowlabel(self, jrow):
             return self.cell(jrow, 3+COLSKIP)
 
+    # The table index of the current sheet.  It is built with one pass over
+    # the sheet the first time a table is looked up.  It has one entry for
+    # each table:
+    #   index[table_num]["row"]     : the row with the "Table" mark
+    #   index[table_num]["rows"]    : {rowname: row}, the first row wins
+    #   index[table_num]["columns"] : {startcolumn: {colname: column}}
+    # The row names are scanned the same way "findtablerow" always did: the
+    # table ends at the first row without a label, but the first four rows
+    # (HEADINGS, UNITS, MARKS, etc) are always included.  "vit" and "vits"
+    # start their scans from the "Table" row itself, so they stop earlier:
+    #   index[table_num]["vitend"]  : the row where "vit" stops
+    #   index[table_num]["end"]     : the row where "vits" stops
+    def sheetindex(self):
+        index=self.tindex.get(self.ws)
+        if index==None:
+            index={}
+            labels=[None]  # labels[k] is the label in row k
+            for row in self.ws.iter_rows(min_col=1, max_col=4, values_only=True):
+                labels.append(self.cellvalue(row[2]))
+                if row[2]=="Table" and not row[3] in index:
+                    index[row[3]]={"row":len(labels)-1}
+            labels.append(None)
+            nlabels=len(labels)-1
+            if self.Trace:
+                self.count("rowsscanned", nlabels-1)
+            for t in index.values():
+                k=t["row"]+1
+                while k<nlabels and labels[k]!=None:
+                    k+=1
+                t["end"]=k
+                k=max(k, t["row"]+4)
+                while k<nlabels and labels[k]!=None:
+                    k+=1
+                t["vitend"]=k
+                rows={}
+                k=t["row"]+1
+                nrows=0
+                while k<nlabels and (labels[k]!=None or nrows<4):
+                    if labels[k]!=None and not labels[k] in rows:
+                        rows[labels[k]]=k
+                    k+=1
+                    nrows+=1
+                t["rows"]=rows
+                t["columns"]={}
+            self.tindex[self.ws]=index
+        return index
+
+    def tableindex(self, table_num):
+        return self.sheetindex().get(table_num)
+
+    # The row of "rowname" as "vit" finds it
+    def tablerowof(self, t, rowname):
+        if rowname=="Table":
+            return t["row"]
+        k=t["rows"].get(rowname)
+        if k==None or k>=t["vitend"]:
+            return None
+        return k
+
+    # The rows of the labels of all the tables of the workbook:
+    #   {label: [(sheetname, table_num, row), ...]}
+    # in sheet order, then table number order.  Only the data rows (from
+    # FIRSTDATAROW) that "vit" would find are listed.  A label can then be
+    # found without knowing its sheet or its table.
+    def rowindex(self):
+        windex=self.windex
+        if windex==None:
+            windex={}
+            for sheetname in self.wb.sheetnames:
+                v=self.view(sheetname)
+                index=v.sheetindex()
+                tables=[n for n in index if type(n) in (int, float)]
+                for table_num in sorted(tables):
+                    t=index[table_num]
+                    for (label, row) in t["rows"].items():
+                        if row>=t["row"]+5 and v.tablerowof(t, label)==row:
+                            windex.setdefault(label, []).append((sheetname, table_num, row))
+            self.windex=windex
+        return windex
+
+    # Column positions of the headings, starting from "startcolumn"
+    def tablecolumns(self, table_num, startcolumn=6):
+        t=self.tableindex(table_num)
+        if t==None:
+            return None
+        columns=t["columns"].get(startcolumn)
+        if columns==None:
+            columns={}
+            j=startcolumn
+            for row in self.ws.iter_rows(min_row=t["row"]+1, max_row=t["row"]+1,
+                                         min_col=startcolumn, values_only=True):
+                for v in row:
+                    scol=self.cellvalue(v)
+                    if scol==None:
+                        break
+                    if not scol in columns:
+                        columns[scol]=j
+                    j+=1
+            t["columns"][startcolumn]=columns
+        return columns
+
+    # Drop the table and label indexes and the cached cell values of the current sheet.
+    # They will be rebuilt when they are needed next.  Call this if you write
+    # into "self.ws" directly.
+    def reindex(self):
+        self.tindex.pop(self.ws, None)
+        self.lindex.pop(self.ws, None)
+        self.qindex.pop(self.ws, None)
+        self.windex=None
+        self.vcache.pop(self.ws, None)
+        self.fcalc.pop(self.ws, None)
+
+    # A write to a cell invalidates its cached value.  A write to a label,
+    # a table mark or a heading also invalidates the table index.  The label
+    # index is updated with the new "value".
+    def touch(self, row, column, value=None):
+        labels=self.lindex.get(self.ws, {}).get(column-1)
+        if labels!=None:
+            old=self.ws.cell(row=row, column=column).value
+            if old!=None and labels.get(old)==row:  # The next row with this label is not known
+                self.lindex[self.ws].pop(column-1)
+            elif value!=None and (not value in labels or labels[value]>row):
+                labels[value]=row
+        cache=self.vcache.get(self.ws)
+        if cache!=None:
+            cache.pop((row, column), None)
+        if self.qindex:
+            self.qindex.pop(self.ws, None)
+        if column==3 or column==4:  # The labels or the table numbers
+            self.windex=None
+        f=self.fcalc.get(self.ws)
+        if f!=None:
+            f.changed(row, column)
+        index=self.tindex.get(self.ws)
+        if index==None:
+            return
+        if column==3 or column==4:
+            self.tindex.pop(self.ws, None)
+            return
+        for t in index.values():
+            if row==t["row"]+1:
+                self.tindex.pop(self.ws, None)
+                return
+
     def findtable(self, table_num):
-        k=0
-        for row in self.ws.rows:
-            k+=1
-            if row[2].value=="Table" and row[3].value==table_num:
-                return k
-        return None
+        t=self.tableindex(table_num)
+        if t==None:
+            return None
+        return t["row"]
 
     def findtablecolumn(self, table_num, colname, startcolumn=6):
-        tablerow=self.findtable(table_num)
-        j=startcolumn
-        scol=self.cell(tablerow+1, j)
-        while (scol!=None):
-            if scol==colname:
-                return j
-            j+=1
-            scol=self.cell(tablerow+1, j)  # The heading for column j
-        return 0
+        columns=self.tablecolumns(table_num, startcolumn)
+        if columns==None:
+            return 0
+        return columns.get(colname, 0)
 
     def findtablerow(self, table_num, name_wanted):
-        i = self.findtable(table_num)+1
+        t=self.tableindex(table_num)
         if name_wanted=='FIRSTDATAROW':
-            return i+4
-        nrows=0
-        rowname=self.cell(i, 3)
-        while (rowname!=None or nrows<4):
-            if rowname==name_wanted:
-                return i
-            i+=1
-            nrows+=1
-            rowname=self.cell(i, 3)
+            return t["row"]+5
+        return t["rows"].get(name_wanted)
     def mdtable(self, table_num, md, startcolumn=6, showlabel=False):
         irow=self.findtablerow(table_num, "FIRSTDATAROW")
         heading_row=irow-4
@@ -284,6 +1463,119 @@ class Xcel:
             irow+=1
             x=self.cell(irow, startcolumn-1)
 
+    # Read the whole table in one pass.  Returns (labels, columns):
+    #   labels  : the row names (column C) of the data rows
+    #   columns : {heading: array of the values in that column}
+    # The data rows start at FIRSTDATAROW and end at the first row without
+    # a label.  The values are what "cell" would return.  A column with
+    # only numbers (and empty cells) is a float array with NaN for the empty
+    # cells; any other column is an object array.
+    def table_array(self, table_num, startcolumn=6):
+        t=self.tableindex(table_num)
+        if t==None:
+            return None
+        columns=self.tablecolumns(table_num, startcolumn)
+        headings=sorted(columns.keys(), key=lambda h: columns[h])
+        labels=[]
+        values=[]
+        for row in self.ws.iter_rows(min_row=t["row"]+5, min_col=3, values_only=True):
+            label=self.cellvalue(row[0])
+            if label==None:
+                break
+            labels.append(label)
+            values.append([self.force(self.cellvalue(row[columns[h]-3])) if columns[h]-3<len(row)
+                           else None for h in headings])
+        data={}
+        for j, h in enumerate(headings):
+            v=[r[j] for r in values]
+            if all(type(z) in (int, float) or z==None for z in v):
+                data[h]=np.array([np.nan if z==None else z for z in v], dtype=float)
+            else:
+                data[h]=np.array(v, dtype=object)
+        return (np.array(labels, dtype=object), data)
+
+    # QUERY()
+    # The rows of a table that meet all the conditions in "where", e.g.
+    #   x.query(1, where={"SYMPA": (300, None), "RHO": (None, 8000)},
+    #           select=["SUMPA", "SYMPA"], order_by="-SYMPA")
+    # A condition is a tuple (low, high) for a range with both ends included
+    # (None for an open end), a list for a set of values, or a value.
+    # The numbers and the strings of a column are compared separately.
+    # "select" is the list of headings returned (all by default) and
+    # "order_by" is a heading, or "-heading" for descending order; the rows
+    # are in table order otherwise.  Returns (labels, {heading: array}) as
+    # "table_array" does, for the rows found.
+    # The table is read and each column is sorted once, when first queried,
+    # so a condition is a binary search.  A write into the sheet drops them.
+    def query(self, table_num, where={}, select=None, order_by=None, startcolumn=6, sheet=None):
+        self.sheet(sheetname=sheet)
+        q=self.tablequery(table_num, startcolumn)
+        if q==None:
+            return None
+        (labels, data)=q["table"]
+        rows=None
+        for (heading, condition) in where.items():
+            if type(condition)==tuple:
+                found=self.queryrange(q, heading, condition[0], condition[1])
+            elif type(condition) in (list, set):
+                found=[self.queryrange(q, heading, v, v) for v in condition]
+                found=np.unique(np.concatenate(found+[np.zeros(0, dtype=int)]))
+            else:
+                found=self.queryrange(q, heading, condition, condition)
+            rows=found if rows is None else np.intersect1d(rows, found, assume_unique=True)
+        if rows is None:
+            rows=np.arange(len(labels))
+        if order_by!=None:
+            descending=order_by[:1]=="-"
+            v=data[order_by[1:] if descending else order_by][rows]
+            if v.dtype==object:  # The missing values stay last
+                present=[i for i in range(len(v)) if orderkey(v[i])[0]<2]
+                missing=[i for i in range(len(v)) if orderkey(v[i])[0]==2]
+                order=sorted(present, key=lambda i: orderkey(v[i]), reverse=descending)+missing
+            else:
+                order=np.argsort(-v if descending else v, kind="stable")  # NaN last
+            rows=rows[np.asarray(order, dtype=int)]
+        if select==None:
+            select=list(data.keys())
+        return (labels[rows], {h: data[h][rows] for h in select})
+
+    # The table of "query" and its sorted columns
+    def tablequery(self, table_num, startcolumn=6):
+        queries=self.qindex.get(self.ws)
+        if queries==None:
+            queries=self.qindex[self.ws]={}
+        q=queries.get((table_num, startcolumn))
+        if q==None:
+            table=self.table_array(table_num, startcolumn)
+            if table==None:
+                return None
+            q=queries[(table_num, startcolumn)]={"table": table, "sorted": {}}
+        return q
+
+    # The positions, in table order, of the rows with low<=value<=high in "heading"
+    def queryrange(self, q, heading, low, high):
+        kind=str if type(low if low!=None else high)==str else float
+        s=q["sorted"].get((heading, kind))
+        if s==None:
+            v=q["table"][1].get(heading)
+            if v is None:
+                raise KeyError("Table has no column '%s'"%heading)
+            if v.dtype==object:
+                keep=[i for (i, z) in enumerate(v) if orderkey(z)[0]==(1 if kind==str else 0)]
+                values=np.array([kind(v[i]) for i in keep], dtype=object if kind==str else float)
+            elif kind==float:
+                keep=np.nonzero(~np.isnan(v))[0]
+                values=v[keep]
+            else:
+                keep=[]
+                values=np.zeros(0, dtype=object)
+            order=np.argsort(values, kind="stable")
+            s=q["sorted"][(heading, kind)]=(values[order], np.asarray(keep, dtype=int)[order])
+        (values, positions)=s
+        i=0 if low==None else np.searchsorted(values, low, side="left")
+        j=len(values) if high==None else np.searchsorted(values, high, side="right")
+        return np.sort(positions[i:j])
+
     # VIT()
     # if "value"=None:
     #       return the value in the cell (rowname, colname)
@@ -291,41 +1583,27 @@ class Xcel:
     #       set the value of the cell to "value"
     def vit(self, table_num, rowname, colname, startcolumn=6, value=None, sheet=None):  # valueintable
         self.sheet(sheetname=sheet)
-        tablerow=self.findtable(table_num)
-        k=tablerow
-        nrows=0
-#        print("Found table : k=%d"%k)
-        srow=self.cell(k, 3)
-        while (srow!=None or nrows<4):
-            if srow==rowname:
-#                print("Found row: %s.  Now search for %s."%(srow, colname))
-                j=startcolumn
-                if colname=="":
-                    return self.cell(k, j, value=value)
-                scol=self.cell(tablerow+1, j)
-                while (scol!=None):
-                    # if srow==rowname and scol==colname:
-                    if scol==colname:
-                        return self.cell(k, j, value=value)
-                    j+=1
-                    scol=self.cell(tablerow+1, j)
-#            else:
-#                print("Looking for %s, skip %s"%(rowname, srow))
-            k+=1
-            nrows+=1
-            srow=self.cell(k, 3)
+        t=self.tableindex(table_num)
+        if t==None:
+            return None
+        k=self.tablerowof(t, rowname)
+        if k==None:
+            return None
+        if colname=="":
+            return self.cell(k, startcolumn, value=value)
+        j=self.tablecolumns(table_num, startcolumn).get(colname)
+        if j==None:
+            return None
+        return self.cell(k, j, value=value)
     def vits(self, table_num, rowname, startcolumn=6, sheet=None):
         self.sheet(sheetname=sheet)
-        tablerow=self.findtable(table_num)
-        k=tablerow
-#        print("Found table : k=%d"%k)
-        srow=self.cell(k, 3)
-        while (srow!=None or k<4):
-            if srow==rowname:
-                return self.cell(k, startcolumn-1)
-            k+=1
-            srow=self.cell(k, 3)
-        return None
+        t=self.tableindex(table_num)
+        if t==None:
+            return None
+        k=self.tablerowof(t, rowname)
+        if k==None or k>=t["end"]:
+            return None
+        return self.cell(k, startcolumn-1)
         
     # Read (or write) the values in a table row.  The default is read.
     # The array "values" is used to pass the values back
@@ -348,15 +1626,29 @@ class Xcel:
 
     # Read "n" values from "rowname" in thetable
     def rnvit(self, table_num, rowname, cols, startcolumn=6):
-        n = len(cols)
-        v = np.zeros(n)
-        i = 0
-        for s in cols:
-            try:
-                v[i]=self.vit(table_num, rowname, s, startcolumn=startcolumn)
-            except:
-                v[i]=0.0
-            i+=1
+        return self.rnvits(table_num, [rowname], cols, startcolumn=startcolumn)[0]
+
+    # Read the values in columns "cols" for all the rows in "rownames".
+    # Returns an array with one row for each rowname.  The value is NaN if the
+    # row, the column or the value is missing, and 0.0 if it is not a number.
+    def rnvits(self, table_num, rownames, cols, startcolumn=6):
+        v = np.full((len(rownames), len(cols)), np.nan)
+        t=self.tableindex(table_num)
+        if t==None:
+            return v
+        columns=self.tablecolumns(table_num, startcolumn)
+        jcols=[startcolumn if s=="" else columns.get(s) for s in cols]
+        for i, rowname in enumerate(rownames):
+            k=self.tablerowof(t, rowname)
+            if k==None:
+                continue
+            for j, jcol in enumerate(jcols):
+                if jcol==None:
+                    continue
+                try:
+                    v[i, j]=self.cell(k, jcol)
+                except:
+                    v[i, j]=0.0
         return v
 
     # Read n numbers from the Table column COLUMNNAME starting from ROWNAME
@@ -386,6 +1678,9 @@ class Xcel:
         self.w2row(irow, startcolumn, v)
 
     def w2row(self, irow, startcolumn, v, color="BLACK", font=None, align=None):
+        if self.writeonly:
+            self.appendrow(irow, startcolumn, v, color=color, font=font, align=align)
+            return
         j=0
         for x in v:
             self.cell(irow, j+startcolumn, color=color, value=v[j],font=font, align=align)
@@ -426,24 +1721,24 @@ class Xcel:
         else:
             return 0
 
+    # The menu of the cell is the last "choices" given for this sheet
     def setcellmenu(self, row, column, choices=None):
-        from openpyxl.worksheet.datavalidation import DataValidation
+        self.writable()
         if choices!=None:
-            self.ws.menudv = DataValidation(type="list", formula1=choices, allow_blank=False, showDropDown = True)
-            self.ws.menudv.prompt=choices
-            self.ws.menudv.error="Valid entries "+choices
-        self.ws.menudv.add(self.ws.cell(row=row, column=column))
-        self.ws.add_data_validation(self.ws.menudv)
+            self.ws.menuchoices=choices
+        self.pulldownmenu(row, column, self.ws.menuchoices)
 
     def setcellcolor(self, row, column, color):
+        self.writable()
         from openpyxl.styles import colors, Font
         cello=self.ws.cell(row=row, column=column)
-        cello.font=Font(color=colortable[color])
+        cello.font=cellstyle(color)[0]
     def setentrycolor(self, rowname, column, color):
         row=self.findrow(rowname)
         self.setcellcolor(row, column, color)
 
     def setcellfill(self, row, column, fillcolor):
+        self.writable()
         from openpyxl.styles import colors, PatternFill
         cello=self.ws.cell(row=row, column=column)
         cello.fill=PatternFill("solid", fgColor=fillcolor)
@@ -471,35 +1766,56 @@ class Xcel:
                 return v
             return self.exceptions
 
+    # The value of a cell as "cell" returns it, but before "force"
+    def cellvalue(self, s):
+        return parsevalue(s, self.ws)
+
+    # The parsed values are cached (self.vcache) so that the parsing is done
+    # once for each cell.  "cachehits" and "cachemisses" count the reads.
+    # The cells with "=A1" references are not cached because their values
+    # depend on other cells.  Formulas are evaluated if "evaluate" is on.
     def cell(self, row, column, value=None, color="BLACK", font=None, align=None):
         from openpyxl.styles import colors, Font
-        cello=self.ws.cell(row=row, column=column)
         if value==None:
-            s=cello.value
-            if type(s)==str:
-                if s[0]=='\ufeff':  # This character sometimes creeps in for files coming from MAC
-                    s=s[1:]
-                try:
-                    z=float(s)
-                except:
-                    z=s
-                s=z
-            # s=cello.value.replace(u'\ufeff', '', 1)
+            if self.writeonly:
+                raise PermissionError("Xcel is write-only")
             if font!=None:
-                cello.font=Font(size=font)
-            if type(s)==str:
-                if s=="":     return 0
-                if s[0]=='=': return self.force(self.ws[s[1:]].value)
-                return self.force(s)
-            else:
+                self.writable()
+                self.ws.cell(row=row, column=column).font=cellstyle(None, font)[0]
+            cache=self.vcache.get(self.ws)
+            if cache==None:
+                cache=self.vcache[self.ws]={}
+            s=cache.get((row, column), cache)  # "cache" means not in the cache
+            if self.Trace:
+                self.count("reads")
+            if s is not cache:
+                self.cachehits+=1
+                if self.Trace:
+                    self.count("cachehits")
                 return self.force(s)
+            self.cachemisses+=1
+            if self.Trace:
+                self.count("cachemisses")
+            raw=self.ws.cell(row=row, column=column).value
+            if self.Evaluate and type(raw)==str and raw[:1]=="=":
+                return self.force(self.formulas().value(row, column))
+            s=self.cellvalue(raw)
+            if not (type(raw)==str and "=" in raw[:2]):
+                cache[(row, column)]=s
+            return self.force(s)
         else:
+            if self.Trace:
+                self.count("writes")
+            if self.writeonly:
+                self.appendrow(row, column, [value], color=color, font=font, align=align)
+                return value
+            self.writable()
+            self.touch(row, column, value)
+            cello=self.ws.cell(row=row, column=column)
             cello.value=value
-            cello.font=Font(color=colortable[color])
-            if font!=None:
-                cello.font=Font(size=font,color=colortable[color])
-            if align!=None:
-                cello.alignment=Alignment(horizontal=align)
+            (cello.font, alignment)=cellstyle(color, font, align)
+            if alignment!=None:
+                cello.alignment=alignment
             self.lastrow=row
             return value
 
@@ -509,9 +1825,11 @@ class Xcel:
         if value==None:
              return self.cell(row=row, column=column)
         else:
+            self.writable()
+            self.touch(row, column, value)
             cello=self.ws.cell(row=row, column=column)
             cello.value=value
-            cello.font=Font(color=colortable[color])
+            cello.font=cellstyle(color)[0]
             return value
 
     def colwidth(self, column, width=None):
@@ -520,6 +1838,7 @@ class Xcel:
         if width==None:
             return (self.ws.column_dimensions[c].width)
         else:
+            self.writable()
             self.ws.column_dimensions[c].width=width+0.64  # 2/2019: I need 0.64
 
     def parsevar(self, v, x2):
@@ -541,48 +1860,168 @@ class Xcel:
         return ("SINGLE", self.cell(row=k, column=column), k, column)
 
     def dvrange(self, row, column, vmin, vmax):
-        from openpyxl.worksheet.datavalidation import DataValidation
-        dv = DataValidation(type="decimal", operator="between", formula1=vmin, formula2=vmax, allow_blank=False)
         choice="a value between %.2f and %.2f"%(vmin, vmax)
-        dv.prompt="Enter "+choice
-        dv.error="Valid entries are "+choice
-        c=get_column_letter(column)
-        dv.ranges.append(c+'%d'%row)
-        self.ws.add_data_validation(dv)
+        self.validate(row, column, ("decimal", "between", vmin, vmax, "Enter "+choice,
+                                    "Valid entries are "+choice, False))
 
     def pulldownmenu(self, row, column, choices):
+        self.validate(row, column, ("list", None, choices, None, choices,
+                                    "Valid entries "+choices, True))
+
+    # DATA VALIDATIONS
+    # The validations are collected by rule, (type, operator, formula1,
+    # formula2, prompt, error, showDropDown), with the cells they apply to.
+    # "validations" writes one DataValidation per rule into each sheet, with
+    # the cells merged into ranges.  "savefile" calls it, so a workbook has
+    # a few rules however many cells are validated.
+    def validate(self, row, column, rule):
+        self.writable()
+        rules=self.dvrules.get(self.ws)
+        if rules==None:
+            rules=self.dvrules[self.ws]={}
+        cells=rules.get(rule)
+        if cells==None:
+            cells=rules[rule]=set()
+        cells.add((row, column))
+
+    def validations(self):
         from openpyxl.worksheet.datavalidation import DataValidation
-        dv = DataValidation(type="list", formula1=choices, allow_blank=False, showDropDown = True)
-        dv.prompt=choices
-        dv.error="Valid entries "+choices
-        c=get_column_letter(column)
-        a=c+'%d'%row
-#        dv.ranges.append(a)
-        dv.ranges.add(a)
-        self.ws.add_data_validation(dv)
+        for (ws, rules) in self.dvrules.items():
+            for dv in self.dvwritten.get(ws, []):  # Written by an earlier save
+                ws.data_validations.dataValidation.remove(dv)
+            written=self.dvwritten[ws]=[]
+            for (rule, cells) in rules.items():
+                (kind, operator, formula1, formula2, prompt, error, dropdown)=rule
+                dv=DataValidation(type=kind, operator=operator, formula1=formula1, formula2=formula2,
+                                  allow_blank=False, showDropDown=dropdown)
+                dv.prompt=prompt
+                dv.error=error
+                dv.sqref=" ".join(cellranges(cells))
+                ws.add_data_validation(dv)
+                written.append(dv)
 
 
     def hidesheet(self):
+        self.writable()
         self.ws.sheet_state='hidden'
         self.hidecolumns()
 
     def hidecolumns(self):
+        self.writable()
         for j in range(0, self.ws.max_column):
             c=get_column_letter(j+1)
             self.ws.column_dimensions[c].width=0
 
-    def openfile(self, filename, sheetname="", data_only=False):
+    def openfile(self, filename, sheetname="", data_only=False, readonly=False):
+        t0=time.perf_counter()
         try:
-            self.wb=load_workbook(filename=filename, data_only=data_only)
+            if readonly:
+                self.wb=Streambook(load_workbook(filename=filename, read_only=True, data_only=data_only))
+            else:
+                self.wb=load_workbook(filename=filename, data_only=data_only)
         except:
             # sys.exit("%s cannot be found"%filename)
             return False
+        self.readonly=readonly
+        self.dvrules={}
+        self.dvwritten={}
+        self.tindex={}
+        self.lindex={}
+        self.vcache={}
+        self.fcalc={}
+        self.qindex={}
+        self.windex=None
+        self.views={}
+        if sheetname=="":
+            self.ws=self.wb.active
+        else:
+            self.ws=self.wb[sheetname]
+        self.opened(t0)
+        return True
+    def opencompiled(self, filename, sheetname="", data_only=True):
+        t0=time.perf_counter()
+        cache=loadcompiled(filename, data_only=data_only)
+        if cache==None:
+            cache=compilefile(filename, data_only=data_only)
+        self.wb=cache["book"]
+        if sheetname=="":
+            self.ws=self.wb.active
+        else:
+            self.ws=self.wb[sheetname]
+        self.tindex={}
+        self.lindex={}
+        self.vcache={}
+        self.fcalc={}
+        self.qindex={}
+        self.windex=None
+        self.views={}
+        for ws in self.wb.worksheets:
+            self.tindex[ws]=cache["index"][ws.title]
+        self.readonly=True
+        self.opened(t0)
+        return True
+
+    # Count an open that started at time "t0" (see tracing)
+    def opened(self, t0):
+        if self.Trace:
+            self.count("opens")
+            self.count("openseconds", time.perf_counter()-t0)
+
+    # Read a workbook published in shared memory by another process (see
+    # Sharedfile).  "handle" is Sharedfile.handle.  The Xcel is read-only.
+    def openshared(self, handle, sheetname=""):
+        t0=time.perf_counter()
+        self.Xcelfilename=handle["source"]
+        self.wb=sharedbook(handle)
         if sheetname=="":
             self.ws=self.wb.active
         else:
             self.ws=self.wb[sheetname]
+        self.tindex={}
+        self.lindex={}
+        self.vcache={}
+        self.fcalc={}
+        self.qindex={}
+        self.windex=None
+        self.views={}
+        for ws in self.wb.worksheets:
+            self.tindex[ws]=handle["index"][ws.title]
+        self.readonly=True
+        self.opened(t0)
         return True
+
+    # Write-only mode: add the values in "v" to row "irow" from "startcolumn".
+    # The rows in between are left empty.  A row cannot be written twice.
+    def appendrow(self, irow, startcolumn, v, color="BLACK", font=None, align=None):
+        if irow<=self.lastrow:
+            raise ValueError("Xcel is write-only: row %d cannot be written after row %d"%(irow, self.lastrow))
+        while self.lastrow<irow-1:
+            self.ws.append([])
+            self.lastrow+=1
+        (cfont, alignment)=cellstyle(color, font, align)
+        row=[None]*(startcolumn-1)
+        for x in v:
+            cello=WriteOnlyCell(self.ws, value=x)
+            cello.font=cfont
+            if alignment!=None:
+                cello.alignment=alignment
+            row.append(cello)
+        self.ws.append(row)
+        self.lastrow=irow
+
+    # Closes the file of a read-only Xcel that has unread sheets
+    def close(self):
+        if isinstance(self.wb, Streambook):
+            self.wb.close()
+
+    # Raises an error if this Xcel cannot be written to
+    def writable(self):
+        if self.readonly:
+            raise PermissionError("Xcel('%s') is read-only"%self.Xcelfilename)
+
     def savefile(self, filename):
+        self.writable()
+        self.validations()
         try:
             self.Xcelfilename=filename
             self.wb.save(filename)
@@ -591,6 +2030,7 @@ class Xcel:
             print("Failed to save "+filename)
             return False
     def addimage(self, picfile, row, column=1):
+        self.writable()
         img=Image(picfile)
         img.anchor(self.ws.cell(row=row, column=column)) # upper right corner of the image
         self.ws.add_image(img)
@@ -598,6 +2038,55 @@ class Xcel:
     def addfunc(self, function_name):
         self.fdic[function_name]
 
+    # A read-only view of sheet "sheetname" that never switches sheets, so
+    # that threads can share this Xcel (see Sheetview)
+    def view(self, sheetname):
+        v=self.views.get(sheetname)
+        if v==None:
+            v=self.views[sheetname]=Sheetview(self, sheetname)
+        return v
+
+# A Sheetview reads one sheet of an Xcel with the whole read API of Xcel
+# (vit, vir, rnvit, table_array, cell, ...).  It shares the workbook, the
+# indexes and the value caches of its Xcel, but it has its own sheet, so
+# lookups through views of different sheets do not race on "Xcel.ws" when
+# threads share one catalog.  A view is read-only and "sheet" cannot move
+# it to another sheet; use the view of that sheet instead.
+# Only "parent", "ws" and "readonly" belong to the view.  The other
+# attributes are read from and written to its Xcel, so "celldefault",
+# "evaluate" and "trace" on the Xcel also apply to its views, and the
+# counters of the views add up in the Xcel.
+class Sheetview(Xcel):
+    own=("parent", "ws", "readonly")
+    def __init__(self, x, sheetname):
+        object.__setattr__(self, "parent", x)
+        object.__setattr__(self, "ws", x.wb[sheetname])
+        object.__setattr__(self, "readonly", True)
+
+    def __getattr__(self, name):
+        return getattr(self.parent, name)
+
+    def __setattr__(self, name, value):
+        if name in Sheetview.own:
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self.parent, name, value)
+
+    def sheet(self, sheetname=None):
+        if sheetname!=None and sheetname!=self.ws.title:
+            raise ValueError("This is a view of sheet '%s'; use view('%s') for sheet '%s'"%(self.ws.title, sheetname, sheetname))
+        return self.ws.title
+
+    def view(self, sheetname):
+        return self.parent.view(sheetname)
+
+    def rowindex(self):
+        return self.parent.rowindex()
+
+# The defaults of Xcel are class attributes, which "__getattr__" never sees
+for name in ("lastrow", "Debug", "Xcelfilename", "writeonly", "Evaluate", "Trace", "wantedtype", "exceptions"):
+    setattr(Sheetview, name, property(lambda self, name=name: getattr(self.parent, name)))
+del name
 
 defaultcellcolor=43
 thin_border = Border(left=Side(style='thin'),
@@ -605,7 +2094,9 @@ thin_border = Border(left=Side(style='thin'),
                     top=Side(style='thin'),
                     bottom=Side(style='thin'))
 from openpyxl.utils import get_column_letter
-def copycellstyles(cell, cello, row, col):
+# Returns (colored, color_index) for the fill of a template cell.  The colored
+# cells are the input cells.
+def cellcolor(cell, row, col):
     try:
         color_index=cell.fill.start_color.index
         if type(color_index)==int:
@@ -623,6 +2114,10 @@ def copycellstyles(cell, cello, row, col):
     except ValueError:
         import sys
         sys.exit("COPYCELLSTYLES error.  color_index='%s'"%color_index)
+    return (colored, color_index)
+
+def copycellstyles(cell, cello, row, col):
+    (colored, color_index)=cellcolor(cell, row, col)
     cello.value=cell.value
     cello.number_format=cell.number_format
     cello.font=cell.font.copy(bold=cell.font.bold, size=cell.font.size)
@@ -643,6 +2138,7 @@ def copystyles(x1, r1, c1, x2, r2, c2):
 
 from openpyxl.utils import get_column_letter
 def copyrow(x1, r1, x2, r2):
+    x2.reindex()
     for j in range(0, x1.ws.max_column):
         cell =x1.ws.cell(row=r1, column=j+1)
         cello=x2.ws.cell(row=r2, column=j+1)
@@ -671,23 +2167,181 @@ def copycolumnwidths(x1, x2):
         if column_width!=None:
             x2.ws.column_dimensions[c].width=column_width
 
+# A short list of rectangular ranges, e.g. ["E5:E9", "G5:H5"], that
+# covers the (row, column) "cells".  The rows of each column are merged into
+# runs first, then the same runs in adjacent columns.
+def cellranges(cells):
+    columns={}
+    for (row, column) in cells:
+        columns.setdefault(column, []).append(row)
+    runs={}  # (first row, last row): [columns]
+    for column in sorted(columns):
+        rows=sorted(columns[column])
+        first=rows[0]
+        for k in range(1, len(rows)+1):
+            if k==len(rows) or rows[k]!=rows[k-1]+1:
+                runs.setdefault((first, rows[k-1]), []).append(column)
+                if k<len(rows):
+                    first=rows[k]
+    ranges=[]
+    for ((r1, r2), cs) in sorted(runs.items(), key=lambda run: (run[1][0], run[0])):
+        c1=cs[0]
+        for k in range(1, len(cs)+1):
+            if k==len(cs) or cs[k]!=cs[k-1]+1:
+                a="%s%d"%(get_column_letter(c1), r1)
+                b="%s%d"%(get_column_letter(cs[k-1]), r2)
+                ranges.append(a if a==b else a+":"+b)
+                if k<len(cs):
+                    c1=cs[k]
+    return ranges
+
 def cellalpharef(row, column):
     c=get_column_letter(column)
     return (c+"%d"%row)
 
 
-def copyfile(xf1,xf2):
-    for i in range(1, xf1.maxrow()+1):
+# TEMPLATES
+# "copyrow" works out the styles, the variables and the "findrow" targets
+# of every cell again for every copy of a template, and "findrow" scans the
+# sheet each time.  A Template does this work once for the current sheet of
+# a template Xcel.  It keeps, for each cell with a value or a style, the
+# value to write, a shared set of style objects and the data validation to
+# add.  "stamp" then writes a copy in time proportional to the number of
+# these cells.  The copy is the same as the one "copyfile" made with
+# "copyrow": the `rowname[column] variables refer to the first row above
+# with that label and a row stops at a variable that cannot be resolved.
+# The styles are worked out once for each style of the template workbook
+# (see "style_id").  "stamp" adds each of them to the new workbook as a
+# named style and gives it to the cells by name, so that openpyxl shares one
+# style record between the cells instead of looking up the font, the fill,
+# the border and the protection of every cell again.
+LOCKED=Protection(locked=True, hidden=False)
+UNLOCKED=Protection(locked=False, hidden=False)
+TEMPLATENAMES=itertools.count(1)  # The names of the named styles of the templates
+
+class Template:
+    def __init__(self, x1):
+        from copy import copy
+        self.name="melib%d"%next(TEMPLATENAMES)
+        self.rows=[]    # [(row, [(column, value, style number, variable)])]
+        self.styles=[]  # [(number_format, font, border, fill, protection)]
+        styles={}
+        ids={}  # The style number of each style_id of x1's workbook
+        fonts={}
+        fills={}
+        labels={}  # The first row of each label in column C
+        for row in x1.ws.iter_rows():
+            cells=[]
+            for cell in row:
+                s=cell.value
+                if s==None and not cell.has_style:
+                    continue
+                (r, j)=(cell.row, cell.column)
+                k=ids.get(cell.style_id)
+                if k==None:
+                    (colored, color_index)=cellcolor(cell, r, j)
+                    font=copy(cell.font)
+                    font=fonts.setdefault(font, font)
+                    border=thin_border if cell.border.left.style!=None else None
+                    fill=None
+                    if colored:
+                        fill=fills.get(color_index)
+                        if fill==None:
+                            fill=fills[color_index]=PatternFill(fill_type='solid', start_color=color_index)
+                        style=(cell.number_format, font, thin_border, fill, UNLOCKED)
+                    else:
+                        style=(cell.number_format, font, border, None, LOCKED)
+                    k=styles.get(style)
+                    if k==None:
+                        k=styles[style]=len(self.styles)
+                        self.styles.append(style)
+                    ids[cell.style_id]=k
+                variable=None
+                if type(s)==str and s[:1]=='`':
+                    variable=self.variable(x1, s[1:], labels, r)
+                    if variable[0]=="DATA RANGE":
+                        s=""
+                    elif variable[0]=="SINGLE":
+                        s="="+variable[1]
+                        variable=None
+                cells.append((j, s, k, variable))
+                if j==3 and s!=None and not s in labels:
+                    labels[s]=r
+            if len(cells)>0:
+                self.rows.append((row[0].row, cells))
+        self.widths={}
+        for j in range(0, x1.ws.max_column):
+            c=get_column_letter(j+1)
+            column_width=x1.ws.column_dimensions[c].width
+            if column_width!=None:
+                self.widths[c]=column_width
+
+    # Parses a template variable (see Xcel.parsevar)
+    def variable(self, x1, v, labels, r):
         try:
-            copyrow(xf1, i, xf2, i)
+            if v[0]=='(' or v[0]=='"':
+                return x1.parsevar(v, None)
+            z=v.lstrip().split("[",1)
+            column=int(z[1][:-1])
+            k=labels[z[0]]
+            return ("SINGLE", "%s%d"%(get_column_letter(column), k))
         except:
-            print("\ncopyrow(%d) error"%i)
-    copycolumnwidths(xf1, xf2)
+            return ("ERROR", r)
+
+    # Writes a copy of the template into the current sheet of x2
+    # The names of the styles in the workbook "wb".  They are added to it
+    # the first time.
+    def namedstyles(self, wb):
+        names=[]
+        for (k, (number_format, font, border, fill, protection)) in enumerate(self.styles):
+            name="%s-%d"%(self.name, k)
+            if not name in wb.named_styles:
+                wb.add_named_style(NamedStyle(name=name, number_format=number_format, font=font,
+                                              border=border if border!=None else DEFAULT_BORDER,
+                                              fill=fill if fill!=None else DEFAULT_EMPTY_FILL,
+                                              protection=protection))
+            names.append(name)
+        return names
+
+    def stamp(self, x2):
+        x2.reindex()
+        ws=x2.ws
+        names=self.namedstyles(x2.wb)
+        for (r, cells) in self.rows:
+            for (j, s, k, variable) in cells:
+                cello=ws.cell(row=r, column=j)
+                cello.style=names[k]
+                cello.value=s
+                if variable!=None:
+                    if variable[0]=="DATA RANGE":
+                        x2.dvrange(r, j, variable[1], variable[2])
+                    elif variable[0]=="MENU":
+                        x2.pulldownmenu(r, j, variable[1])  # variable[1]=choices for pulldown menu
+                    else:
+                        print("\ncopyrow(%d) error"%r)
+                        break
+        for c in self.widths:
+            ws.column_dimensions[c].width=self.widths[c]
+
+TEMPLATES=OrderedDict()  # The templates read by "excelfile", the last used at the end
+TEMPLATECACHE=8  # The number of templates kept in TEMPLATES
+
+def copyfile(xf1,xf2):
+    Template(xf1).stamp(xf2)
 
 def excelfile(filename, sheetname=""):
-    xf1=Xcel(filename, sheetname=sheetname)
+    import os
+    st=os.stat(filename)
+    key=(os.path.realpath(filename), sheetname, st.st_size, st.st_mtime_ns)
+    template=TEMPLATES.get(key)
+    if template==None:
+        template=TEMPLATES[key]=Template(Xcel(filename, sheetname=sheetname))
+        while len(TEMPLATES)>TEMPLATECACHE:
+            TEMPLATES.popitem(last=False)
+    else:
+        TEMPLATES.move_to_end(key)
     xf2=Xcel()
-    copyfile(xf1,xf2)
+    template.stamp(xf2)
     # if tofile=="":
     #     tofile=filename
     # xf2.savefile(tofile)
@@ -11,7 +11,7 @@ import numpy as np
 import sys
 # sys.path.insert(0, ".")
 from melib.xt import mdxziplist,engfmt,openplot
-from melib.excel import Xcel
+from melib.excel import Xcel, compilefile, Sharedfile
 
 PIE = math.pi
 CALCRECORD = ""
@@ -36,7 +36,124 @@ TESTING = ""
 #
 SVAR = " _ssssss_ "
 NVAR = " _nnnnnn_ "
-# the arguments should str, e.g. unitconvert("Calories_per_Cm2Min","W_per_M2")
+class Unitregistry:
+    """ Units and the factors to convert between them.  A unit is a factor
+    times a power of the base units m, kg and s.  The compound units are
+    written with "-", "*" or a space for products, "/" or "_per_" for
+    quotients and a trailing exponent, e.g. "N-m", "kg/m2-h", "lbf/in^2",
+    "W_per_M2", "kg-m-s^-2".  The names are case-sensitive ("MPa", "Mm" is
+    not "mm"); the other spellings of a unit are listed with `alias` ("Kg").
+    An unknown unit raises KeyError.  Two units can be converted if they
+    have the same dimensions.  The factor of each (from, to) pair is
+    computed once.  `UNITS` is the registry of `unitconvert`.
+
+    Example
+
+        >>> UNITS.factor("lbf-in", "N-m")
+        >>> UNITS.convert(np.array([1.0, 2.0]), "ksi", "MPa")   # One multiply
+        >>> UNITS.define("mil", "in", 0.001)
+        >>> UNITS.alias("sec", "s")
+
+    """
+    def __init__(self):
+        self.units = {"m": (1.0, (1, 0, 0)), "kg": (1.0, (0, 1, 0)), "s": (1.0, (0, 0, 1)),
+                      "1": (1.0, (0, 0, 0))}
+        self.aliases = {}  # name: unit
+        self.factors = {}  # (fromunit, tounit): factor
+
+    def define(self, name, expression, scale=1.0):
+        """ Defines `name` as `scale` times the unit `expression`, e.g.
+        `define("mm", "m", 0.001)` or `define("N", "kg-m/s2")`
+        """
+        (f, dims) = self.parse(expression)
+        self.units[name] = (scale*f, dims)
+
+    def alias(self, name, unit):
+        """ `name` is another spelling of the unit `unit`, e.g. `alias("Kg", "kg")` """
+        self.aliases[name] = unit
+
+    def pair(self, fromunit, tounit, factor):
+        """ Sets the factor of one (from, to) pair, whatever the units say """
+        self.factors[(fromunit, tounit)] = factor
+        self.factors[(tounit, fromunit)] = 1.0/factor
+
+    def unit(self, name):
+        u = self.units.get(self.aliases.get(name, name))
+        if u == None:
+            raise KeyError("Unknown unit '%s'" % name)
+        return u
+
+    def parse(self, expression):
+        """ Returns (factor, dimensions) of the unit `expression` """
+        import re
+        u = self.units.get(expression)
+        if u != None:
+            return u
+        f = 1.0
+        dims = np.zeros(3, dtype=int)
+        parts = expression.replace("_per_", "/").split("/")
+        for (k, part) in enumerate(parts):
+            sign = 1 if k == 0 else -1  # Everything after a "/" divides
+            for token in re.split(r"\*|\s+|(?<!\^)-", part.strip()):  # Not the "-" of "^-2"
+                if token == "":
+                    continue
+                m = re.match(r"^(.*?)\^?(-?\d*)$", token)
+                (name, power) = (m.group(1), m.group(2))
+                if name == "":  # A number, e.g. the "1" of "1/s"
+                    (name, power) = (token, "")
+                (uf, ud) = self.unit(name)
+                power = sign*(int(power) if power not in ("", "-") else 1)
+                f *= uf**power
+                dims += power*np.array(ud)
+        return (f, tuple(int(d) for d in dims))
+
+    def factor(self, fromunit, tounit):
+        """ The factor that converts a value in `fromunit` to `tounit` """
+        f = self.factors.get((fromunit, tounit))
+        if f == None:
+            (f1, d1) = self.parse(fromunit)
+            (f2, d2) = self.parse(tounit)
+            if d1 != d2:
+                raise ValueError("Cannot convert %s to %s: the dimensions differ" % (fromunit, tounit))
+            f = f1/f2
+            self.factors[(fromunit, tounit)] = f
+        return f
+
+    def convert(self, x, fromunit, tounit):
+        """ `x` (a number or an array) converted from `fromunit` to `tounit` """
+        return np.asarray(x)*self.factor(fromunit, tounit) if np.ndim(x) > 0 else x*self.factor(fromunit, tounit)
+
+
+UNITS = Unitregistry()
+for (name, expression, scale) in [
+        # Length, mass, time
+        ("mm", "m", 1e-3), ("cm", "m", 1e-2), ("dm", "m", 0.1), ("km", "m", 1e3), ("um", "m", 1e-6),
+        ("in", "m", 0.0254), ("inch", "in", 1), ("ft", "in", 12), ("yd", "ft", 3), ("mi", "ft", 5280),
+        ("g", "kg", 1e-3), ("mg", "kg", 1e-6), ("t", "kg", 1e3), ("lb", "kg", 0.45359237),
+        ("min", "s", 60), ("h", "s", 3600), ("hr", "h", 1), ("day", "h", 24),
+        # Angle, speed
+        ("rad", "1", 1), ("rev", "rad", 2*math.pi), ("deg", "rad", math.pi/180), ("rpm", "rev/min", 1),
+        # Force
+        ("N", "kg-m/s2", 1), ("kN", "N", 1e3), ("MN", "N", 1e6), ("kgf", "N", 9.80665),
+        ("lbf", "N", 4.4482216152605), ("kip", "lbf", 1e3), ("dyn", "N", 1e-5),
+        # Stress
+        ("Pa", "N/m2", 1), ("kPa", "Pa", 1e3), ("MPa", "Pa", 1e6), ("GPa", "Pa", 1e9), ("bar", "Pa", 1e5),
+        ("psi", "lbf/in2", 1), ("ksi", "psi", 1e3),
+        # Energy, power
+        ("J", "N-m", 1), ("kJ", "J", 1e3), ("MJ", "J", 1e6), ("cal", "J", 4.184), ("kcal", "cal", 1e3),
+        ("Btu", "J", 1055.05585), ("W", "J/s", 1), ("kW", "W", 1e3), ("MW", "W", 1e6), ("hp", "W", 745.699872),
+        ("Wh", "W-h", 1), ("kWh", "kW-h", 1)]:
+    UNITS.define(name, expression, scale)
+for (name, unit) in [("Kg", "kg"), ("KG", "kg"), ("sec", "s"), ("secs", "s"), ("hrs", "h"), ("lbm", "lb"),
+                     ("inches", "in"), ("feet", "ft"), ("Mpa", "MPa"), ("MPA", "MPa"), ("Gpa", "GPa")]:
+    UNITS.alias(name, unit)
+# The names of the original unitconvert are only known in its pairs, with
+# its coefficients, which are not those of the units ("Grams_per_Dm2Hr" to
+# "Kg_per_M2H" is 4e-05, but g/dm2-h to kg/m2-h is 0.1).  They are kept out
+# of the units so that no chain of conversions can contradict a pair.
+UNITS.pair("Calories_per_Cm2Min", "W_per_M2", 697)
+UNITS.pair("Grams_per_Dm2Hr", "Kg_per_M2H", 4e-05)
+UNITS.pair("Lbf_inch", "N-m", 0.113)  # 1 lbf-in=1/2.204*9.81*0.0254 N-m
 
 
 def unitconvert(fromunit, tounit):
@@ -46,7 +163,12 @@ def unitconvert(fromunit, tounit):
 
     will convert 'x' in units of 'Cal/(cm2-min)' to 'y' in 'Watts/m2'.
 
-    The supported unit pairs are:
+    Any two units of the same dimensions can be converted, including
+    compound units, e.g. `unitconvert("lbf-in", "N-m")`,
+    `unitconvert("kg/m2-h", "g/dm2-h")` or `unitconvert("ksi", "MPa")`.
+    See `Unitregistry` for the units and the syntax.  The names of the
+    original pairs can only be converted to each other, with the original
+    coefficients:
 
     * "Calories_per_Cm2Min" ---> "W_per_M2"
 
@@ -54,14 +176,7 @@ def unitconvert(fromunit, tounit):
 
     * "Lbf_inch"            ---> "N-m"
     """
-    # Irradiance from calories/(cm2-min)
-    Calories_per_Cm2Min = {'W_per_M2': 697}
-    # Transpiration rate from g/(dm2-h)
-    Grams_per_Dm2Hr = {"Kg_per_M2H": 4e-05}
-    Lbf_inch = {"N-m": 0.113}  # 1 lbf-in=1/2.204*9.81*0.0254 N-m
-    x = eval(fromunit)
-    y = x[tounit]
-    return y
+    return UNITS.factor(fromunit, tounit)
 
 
 def dictquery(d, k):
@@ -78,55 +193,174 @@ def dictquery(d, k):
     return (False, k)
 
 
+class Propertytables:
+    """ Material property tables, compiled once into arrays.  A property of a
+    metal is either one value or a table of values against temperature[ :superscript:`o` C],
+    which is interpolated.  `value` takes a metal name or an array of names
+    and a temperature or an array of temperatures, and returns an array of
+    the same shape (or a number).  `thconductivity` and `density` read the
+    `PROPERTIES` registry.
+
+    Example
+
+        >>> PROPERTIES.value("thconductivity", "inconel 750", np.linspace(200, 800, 1000))
+        >>> PROPERTIES.value("density", ["steel", "alum", "ss304"])
+        >>> PROPERTIES.add("density", "copper", 8960)
+        >>> PROPERTIES.load(catalog("mats").view("data"), 3, {"Density": "density", "Thermal Cond": "thconductivity"})
+
+    """
+    def __init__(self):
+        self.tables = {}  # property: {metal: (temperatures or None, values)}
+        self.names = {}   # property: description, e.g. "Density[kg/m3]"
+
+    def add(self, prop, metal, values, T=None, name=None):
+        """ Adds (or replaces) the values of `prop` for `metal`.  `T` are the
+        temperatures of the `values`; a single value does not need `T`.
+        """
+        values = np.atleast_1d(np.asarray(values, dtype=float))
+        if T is not None:
+            T = np.asarray(T, dtype=float)
+            order = np.argsort(T)
+            (T, values) = (T[order], values[order])
+        self.tables.setdefault(prop, {})[metal] = (T, values)
+        if name != None:
+            self.names[prop] = name
+
+    def load(self, x, tablenum, props, T=None):
+        """ Adds the values in table `tablenum` of the Xcel (or sheet view)
+        `x`, one metal per row (the row labels are the metal names).
+
+        `props` : {heading: property} for the columns that hold one value
+        per metal, or the name of one property if the headings are the
+        temperatures `T` of the values (the headings must be numbers then).
+        """
+        (labels, data) = x.table_array(tablenum)
+        if type(props) == str:
+            headings = list(data.keys())
+            if T is None:
+                T = [float(h) for h in headings]
+            v = np.array([data[h] for h in headings], dtype=float).T
+            for (metal, row) in zip(labels, v):
+                ok = ~np.isnan(row)
+                if ok.any():
+                    self.add(props, metal, row[ok], np.asarray(T, dtype=float)[ok])
+            return
+        for (heading, prop) in props.items():
+            for (metal, v) in zip(labels, data[heading]):
+                if type(v) in (int, float, np.float64) and not np.isnan(v):
+                    self.add(prop, metal, v)
+
+    def query(self, prop):
+        """ The list of the metals of `prop` (the answer to `thconductivity("?")`) """
+        z = "%s data exist only for the following ('+++' means that a second argument needs to be provided, e.g. temperature):\n\n" % (
+            self.names.get(prop, prop))
+        for (metal, (T, values)) in self.tables.get(prop, {}).items():
+            z += "* "+metal+(" +" if T is not None else "")+"\n"
+        return z
+
+    def value(self, prop, metal, T=[], missing=None):
+        """ The value of `prop` for `metal` at temperature `T`.  With no `T`,
+        the first temperature of the table.  A metal without data raises
+        KeyError, or gets `missing` if it is given.
+        """
+        table = self.tables.get(prop, {})
+        if type(metal) == str:
+            t = table.get(metal)
+            if t == None:
+                if missing == None:
+                    raise KeyError(metal)
+                return missing
+            (Ts, values) = t
+            if Ts is None:
+                return values[0] if np.ndim(T) == 0 or len(T) == 0 else np.full(np.shape(T), values[0])
+            if np.ndim(T) > 0 and len(T) == 0:
+                T = Ts[0]
+            return np.interp(T, Ts, values)
+        metal = np.asarray(metal, dtype=object)
+        T = np.broadcast_to(np.nan if np.ndim(T) > 0 and len(T) == 0 else np.asarray(T, dtype=float), metal.shape)
+        v = np.empty(metal.shape)
+        for m in set(metal.flat):  # One interpolation per metal
+            rows = metal == m
+            t = table.get(m)
+            if t == None:
+                if missing == None:
+                    raise KeyError(m)
+                v[rows] = missing
+                continue
+            (Ts, values) = t
+            if Ts is None:
+                v[rows] = values[0]
+            else:
+                Tm = T[rows]
+                v[rows] = np.interp(np.where(np.isnan(Tm), Ts[0], Tm), Ts, values)
+        return v
+
+
+PROPERTIES = Propertytables()
+PROPERTIES.add("thconductivity", "inconel 750", [16.9, 20.5, 26.5, 28.7, 31.4, 35.3],
+               [149, 316, 538, 649, 760, 871], name="Thermal Conductivity(W/m-C)")
+PROPERTIES.add("thconductivity", "ss304", 16.2)
+PROPERTIES.add("density", "inconel 750", 8250, name="Density[kg/m3]")
+PROPERTIES.add("density", "ss304", 8030)
+PROPERTIES.add("density", "steel", 7850)
+PROPERTIES.add("density", "alum", 2700)
+
+
 def thconductivity(metal, T=[]):
     """ Returns the thermal conductivity[W/m-C] of the metal.  The second argument is the temperature[ :superscript:`o` C].
+    Both can be arrays (see `Propertytables`).
     Enter
 
     >>> print(thconductivity("?"))
 
     to see the supported metals.
     """
-    thca = {"inconel 750": (np.array([149, 316, 538, 649, 760, 871]), np.array([16.9, 20.5, 26.5, 28.7, 31.4, 35.3])),
-            "ss304": (np.array([16.2])), "dname": "Thermal Conductivity(W/m-C)"}
-    q = dictquery(thca, metal)
-    if q[0]:
-        return q[1]
-    if metal in thca.keys():
-        thc = thca[metal]
-        if len(thc) > 1:
-            if T==[]: T=thc[0][0]
-            return np.interp(T, thc[0], thc[1])
-        else:
-            return thc[0]
-    else:
-        print("No Thermal Conductivity data for %s.  Returns 0." % metal)
-        return 0.0
+    if type(metal) == str and metal == "?":
+        return PROPERTIES.query("thconductivity")
+    table = PROPERTIES.tables["thconductivity"]
+    for m in ([metal] if type(metal) == str else set(np.asarray(metal, dtype=object).flat)):
+        if not m in table:
+            print("No Thermal Conductivity data for %s.  Returns 0." % m)
+    return PROPERTIES.value("thconductivity", metal, T, missing=0.0)
 
 
 def density(metal, T=[]):
     """ Returns the density[kg/m3] of the metal.  The optional second argument is the temperature[ :superscript:`o` C].
+    Both can be arrays (see `Propertytables`).
     Enter
 
-    >>> print(thconductivity("?"))
+    >>> print(density("?"))
 
     to see the supported metals.
     """
-    density_data = {"inconel 750": (np.array([8250])), "ss304": (np.array([8030])),
-                    "steel": (np.array([7850])), "alum": (np.array([2700])), "dname": "Density[kg/m3]"}
-    q = dictquery(density_data, metal)
-    if q[0]:
-        return q[1]
-    x = density_data[metal]
-    if len(x) > 1:
-        if T==[]: T=x[0][0]
-        return np.interp(T, x[0], x[1])
-    else:
-        return x[0]
+    if type(metal) == str and metal == "?":
+        return PROPERTIES.query("density")
+    return PROPERTIES.value("density", metal, T)
 
 #
 
 
-def opendatafiles(tags=["bearing", "mats", "sgear", "shaft", "vbelt"], makezip=False):
+def datafilename(tag):
+    import os
+    pt = os.path.dirname(os.path.realpath(__file__))
+    return os.path.join(pt, "data", "%s.xlsx" % tag)
+
+
+DATALOADS = {}  # tag: {"file", "bytes", "seconds"} of the last load (see opendatafiles)
+
+
+def opendatafile(tag, compiled=False):
+    import os, time
+    fname = datafilename(tag)
+    t0 = time.perf_counter()
+    x = Xcel(fname, compiled=compiled)
+    DATALOADS[tag] = {"file": fname, "bytes": os.path.getsize(fname),
+                      "seconds": time.perf_counter()-t0}
+    return x
+
+
+def opendatafiles(tags=["bearing", "mats", "sgear", "shaft", "vbelt"], makezip=False, compiled=False,
+                  parallel=False):
     """
 
     Action
@@ -140,26 +374,146 @@ def opendatafiles(tags=["bearing", "mats", "sgear", "shaft", "vbelt"], makezip=F
         `makezip` : Boolean.
         Whether to add the files to a zip package (used in notebooks).
 
+        `compiled` : Boolean.
+        Read the files from their compiled caches (see `compiledatafiles`).
+        The caches are much quicker to load, but the pointers are read-only
+        and have no cell styles.  The default opens the workbooks themselves,
+        so that the pointers can be edited.  `CATALOGS` uses the caches.
+
+        `parallel` : Boolean.
+        Load the files concurrently, one thread per file.  The pointers are
+        returned in the order of `tags` all the same.
+
     Returns
         Xcel pointers to the data files.  You may have to use these pointers when calling
-        other `library` functions.
+        other `library` functions.  The size and the load time of each file are
+        recorded in `DATALOADS`.
 
     Example
 
         >>> [Xbear, Xmat, Xgear, Xshaft, Xbelt]=opendatafiles()
+        >>> DATALOADS["mats"]
+        {'file': '.../data/mats.xlsx', 'bytes': 26308, 'seconds': 0.0021}
 
     """
-    x = []
-    import os
-    pt = os.path.dirname(os.path.realpath(__file__))
-    for s in tags:
-        #        datafilename=DATAFOLDER+"\\"+"%s.xlsx"%s
-        datafilename=pt+"\\data\\%s.xlsx"%s
-        x.append(Xcel(datafilename))
-        if makezip:
-            mdxziplist([datafilename])
+    if parallel and len(tags) > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=len(tags)) as pool:
+            x = list(pool.map(lambda s: opendatafile(s, compiled), tags))
+    else:
+        x = [opendatafile(s, compiled) for s in tags]
+    if makezip:
+        mdxziplist([datafilename(s) for s in tags])
     return x
 
+
+class Catalogs:
+    """ Shared Xcel pointers to the data files.  Each file is opened (from its
+    compiled cache, see `opendatafiles`) the first time it is asked for and
+    the same read-only pointer is returned afterwards.  The library functions
+    use the `CATALOGS` registry when they are not given an Xcel pointer.
+
+    Example
+
+        >>> xmat=CATALOGS.get("mats")   # or catalog("mats")
+        >>> CATALOGS.reload(["mats"])   # Re-open after mats.xlsx is edited
+        >>> CATALOGS.clear()            # Forget all the pointers
+
+    """
+    def __init__(self):
+        import threading
+        self.xcels = {}
+        self.lock = threading.Lock()
+
+    def get(self, tag):
+        x = self.xcels.get(tag)
+        if x == None:
+            with self.lock:  # Only one thread opens the file
+                x = self.xcels.get(tag)
+                if x == None:
+                    x = opendatafiles(tags=[tag], compiled=True)[0]
+                    self.xcels[tag] = x
+        return x
+
+    def reload(self, tags=None):
+        with self.lock:
+            if tags == None:
+                tags = list(self.xcels.keys())
+            for tag in tags:
+                self.xcels[tag] = opendatafiles(tags=[tag], compiled=True)[0]
+
+    def clear(self):
+        with self.lock:
+            self.xcels = {}
+
+    def attach(self, handles):
+        with self.lock:
+            for (tag, handle) in handles.items():
+                x = Xcel()
+                x.openshared(handle)
+                self.xcels[tag] = x
+
+
+CATALOGS = Catalogs()
+
+
+def catalog(tag):
+    """ Returns the shared Xcel pointer to a data file, e.g. `catalog("mats")`.
+    See `Catalogs`.
+    """
+    return CATALOGS.get(tag)
+
+
+def compiledatafiles(tags=["bearing", "mats", "sgear", "shaft", "vbelt"]):
+    """
+
+    Action
+        Compiles the Excel files in the `data` folder into cache files so that
+        `opendatafiles(compiled=True)` and `CATALOGS` do not need to parse the
+        workbooks.  The caches are rebuilt automatically when a data file
+        changes.  This function is only needed if you want to build them in
+        advance, e.g. when installing.
+
+    Example
+
+        >>> compiledatafiles()
+
+    """
+    for s in tags:
+        compilefile(datafilename(s))
+
+def sharedatafiles(tags=["bearing", "mats", "sgear", "shaft", "vbelt"]):
+    """
+
+    Action
+        Publishes the data files once into shared memory for the worker
+        processes of a `multiprocessing` pool.  The workers call
+        `attachdatafiles` with the handles and read the catalogs in place
+        instead of opening the workbooks again.
+
+    Returns
+        A dictionary of `Sharedfile` objects, one per tag.  Call `close()` on
+        each of them when the workers are done.
+
+    Example
+
+        >>> shared=sharedatafiles(["mats", "bearing"])
+        >>> handles={tag: sf.handle for (tag, sf) in shared.items()}
+        >>> with Pool(initializer=attachdatafiles, initargs=(handles,)) as pool:
+        ...     results=pool.map(design, cases)   # alloyprop(None, ...) etc.
+        >>> for sf in shared.values(): sf.close()
+
+    """
+    return {s: Sharedfile(datafilename(s)) for s in tags}
+
+
+def attachdatafiles(handles):
+    """ Attaches this process to the data files published by `sharedatafiles`.
+    `handles` is a dictionary of `Sharedfile.handle` by tag.  The library
+    functions called with `x=None` then read the shared catalogs (see `catalog`).
+    """
+    CATALOGS.attach(handles)
+
 def alloyprop(x, base, alloyname, props):
     """
 
@@ -169,7 +523,8 @@ def alloyprop(x, base, alloyname, props):
     Arguments
         `x` :  Xcel pointer to `mats.xlsx`.  See the file for supported metals.
 
-        `base` : Sheet name in `matx.xlsx`, e.g. *steel*, *alum*, *titanium*, *nickel*
+        `base` : Sheet name in `matx.xlsx`, e.g. *steel*, *alum*, *titanium*, *nickel*.
+        Use `None` to look for the alloy in all the sheets.
 
         `alloyname` : Alloy designation as they appear in column C of the Excel sheet, e.g. "1350-H19"
 
@@ -180,21 +535,100 @@ def alloyprop(x, base, alloyname, props):
         >>> [su, sy, rho]=alloyprop(xmat, "nickel", "N06110", ["SUMPA", "SYMPA", "RHO"])
         >>> print(su, sy, rho)
         >>> 1205.0 1034.0 8330.0
+        >>> [su, sy, rho]=alloyprop(None, None, "N06110", ["SUMPA", "SYMPA", "RHO"])  # Any sheet
+
+    The alloy is found through the index of all the table rows of the file
+    (see `Xcel.rowindex`).  The tables 1 to NOFTABLES of the sheet are tried
+    in order and the first one that has a value for `props[0]` wins; otherwise
+    the values are from table NOFTABLES (all NaN if the alloy is not in it).
 
     """
     if x == None:
-        x = opendatafiles(tags=["mats"])[0]
-        x.sheet(base)
-    else:
-        x.sheet(base)
-    noftables = x.vir("NOFTABLES")
-    tablenum = 1
-    v = x.rnvit(tablenum, alloyname, props)
-    while np.isnan(v[0]) and tablenum < noftables:
-        tablenum += 1
-        v = x.rnvit(tablenum, alloyname, props)
+        x = catalog("mats")
+    (sites, last) = alloysites(x, base, alloyname)
+    for (sheetname, tablenum) in sites:
+        v = x.view(sheetname).rnvit(tablenum, alloyname, props)
+        if not np.isnan(v[0]):
+            return v
+    if last == None:
+        return np.full(len(props), np.nan)
+    return x.view(last[0]).rnvit(last[1], alloyname, props)
+
+def alloysites(x, base, alloyname):
+    """ The tables that `alloyprop` tries for the alloy, `[(sheetname, tablenum)]`,
+    and the one of its values when `props[0]` is in none of them, or `None`
+
+    """
+    sites = []
+    last = None
+    noftables = {}
+    for (sheetname, tablenum, row) in x.rowindex().get(alloyname, []):
+        if base != None and sheetname != base:
+            continue
+        if not sheetname in noftables:
+            noftables[sheetname] = x.view(sheetname).vir("NOFTABLES")
+        n = noftables[sheetname]
+        if n == None or tablenum <= n:
+            sites.append((sheetname, tablenum))
+        if tablenum == n:
+            last = (sheetname, tablenum)
+    return (sites, last)
+
+def alloyprops(x, bases, alloynames, props):
+    """
+
+    Action
+        `alloyprop` for many alloys at once.
+
+    Arguments
+        `x` :  Xcel pointer to `mats.xlsx`, or `None` for the shared one.
+
+        `bases` : One sheet name for all the alloys, a list with the sheet
+        name of each alloy, or `None` to look for the alloys in all the sheets.
+
+        `alloynames` : List of alloy designations.
+
+        `props` : Properties wanted as in the HEADINGS in the file.
+
+    Returns
+        A `len(alloynames)` x `len(props)` array.  Row `i` is
+        `alloyprop(x, bases[i], alloynames[i], props)`; the missing values are NaN.
+        The alloys in the same table are read together (see `Xcel.rnvits`).
+
+    Example
+        >>> v=alloyprops(None, None, ["N06110", "1020 HOT-ROLLED"], ["SYMPA", "RHO"])
+        >>> ratio=v[:, 0]/v[:, 1]   # Specific strength
+
+    """
+    if x == None:
+        x = catalog("mats")
+    n = len(alloynames)
+    if bases == None or type(bases) == str:
+        bases = [bases]*n
+    v = np.full((n, len(props)), np.nan)
+    sites = [alloysites(x, bases[i], alloynames[i]) for i in range(n)]  # As alloyprop tries them
+    todo = [i for i in range(n) if len(sites[i][0]) > 0]
+    k = 0
+    while len(todo) > 0:  # The k-th table of the alloys not found yet
+        readtables(x, v, alloynames, props, [(sites[i][0][k], i) for i in todo])
+        k += 1
+        todo = [i for i in todo if np.isnan(v[i, 0]) and len(sites[i][0]) > k]
+    notfound = [i for i in range(n) if np.isnan(v[i, 0])]
+    v[notfound] = np.nan
+    readtables(x, v, alloynames, props, [(sites[i][1], i) for i in notfound if sites[i][1] != None])
     return v
 
+def readtables(x, v, alloynames, props, sites):
+    """ Read the rows `i` of `v` for `sites`, `[((sheetname, tablenum), i)]`,
+    with one `Xcel.rnvits` per table
+
+    """
+    tables = {}
+    for (site, i) in sites:
+        tables.setdefault(site, []).append(i)
+    for ((sheetname, tablenum), rows) in tables.items():
+        v[rows] = x.view(sheetname).rnvits(tablenum, [alloynames[i] for i in rows], props)
+
 def alumprop(x, alloyname, props):
     """ Short cut for `alloyprop(x, "alum", alloyname, props)`
 
@@ -215,6 +649,167 @@ def steelprop(x, alloyname, props):
     """
     return alloyprop(x, "steel", alloyname, props)
 
+# MATERIAL SELECTION
+
+ALLOYSHEETS = ["steel", "alum", "titanium", "nickel"]
+
+
+def alloytable(x=None, props=None, bases=ALLOYSHEETS):
+    """
+
+    Action
+        Reads every alloy of the `bases` sheets of `mats.xlsx` into arrays.
+
+    Arguments
+        `x` :  Xcel pointer to `mats.xlsx`, or `None` for the shared one.
+
+        `props` : HEADINGS wanted.  All the headings of the sheets by default.
+
+        `bases` : Sheet names.
+
+    Returns
+        `(names, bases, values)`: the alloy designations, the sheet of each
+        alloy and a dictionary of `props` arrays (NaN if missing).  The
+        alloys without a "RHO" value get the density of their base metal when
+        it is known (see `density`).
+
+    Example
+        >>> (names, bases, p)=alloytable(props=["SYMPA", "RHO"])
+        >>> i=np.nanargmax(p["SYMPA"]/p["RHO"])
+
+    """
+    if x == None:
+        x = catalog("mats")
+    names = []
+    sheets = []
+    for (label, sites) in x.rowindex().items():
+        for base in bases:
+            if base in [site[0] for site in sites]:
+                names.append(label)
+                sheets.append(base)
+    headings = []
+    for base in bases:
+        v = x.view(base)
+        for tablenum in v.sheetindex():
+            headings += [h for h in v.tablecolumns(tablenum) if not h in headings]
+    if props == None:
+        props = headings
+    a = alloyprops(x, sheets, names, props)
+    values = {h: a[:, j] for (j, h) in enumerate(props)}
+    if "RHO" in values:
+        for base in set(sheets):
+            try:
+                rho = density(base)
+            except KeyError:
+                continue
+            rows = np.array([s == base for s in sheets]) & np.isnan(values["RHO"])
+            values["RHO"][rows] = rho
+    return (np.array(names, dtype=object), np.array(sheets, dtype=object), values)
+
+
+def paretofront(scores):
+    """ Returns a boolean array that is True for the rows of `scores` (n x k)
+    that are not dominated: no other row is as large in every column and
+    larger in one.  All the columns are maximised.  The rows with NaN are
+    never on the front.
+    """
+    scores = np.asarray(scores, dtype=float)
+    (n, k) = scores.shape
+    front = np.zeros(n, dtype=bool)
+    rows = np.nonzero(~np.isnan(scores).any(axis=1))[0]
+    if len(rows) == 0:
+        return front
+    s = scores[rows]
+    order = np.lexsort(-s.T[::-1])  # Descending, column 0 first: no row dominates an earlier one
+    s = s[order]
+    if k == 1:
+        onfront = s[:, 0] == s[0, 0]
+    elif k == 2:
+        # Row i is dominated by an earlier row with a larger column 1, or by
+        # a row of a larger column 0 with a column 1 as large
+        run = np.maximum.accumulate(s[:, 1])
+        before = np.concatenate([[-np.inf], run[:-1]])
+        start = np.concatenate([[True], s[1:, 0] != s[:-1, 0]])
+        start = np.maximum.accumulate(np.where(start, np.arange(len(s)), 0))
+        larger = np.where(start > 0, run[start-1], -np.inf)
+        onfront = ~((before > s[:, 1]) | (larger >= s[:, 1]))
+    else:
+        # Blocks of rows are checked against the front so far, then the rows
+        # left against the earlier ones of the block
+        onfront = np.zeros(len(s), dtype=bool)
+        f = np.empty((0, k))
+        for b in range(0, len(s), 256):
+            c = s[b:b+256]
+            left = ~((f[:, None] >= c).all(axis=2) & (f[:, None] > c).any(axis=2)).any(axis=0)
+            c = c[left]
+            d = (c[:, None] >= c).all(axis=2) & (c[:, None] > c).any(axis=2)
+            left[left] = ~np.triu(d, 1).any(axis=0)
+            onfront[b:b+256] = left
+            f = np.vstack([f, s[b:b+256][left]])
+    front[rows[order[onfront]]] = True
+    return front
+
+
+def alloyselect(indices, where={}, x=None, bases=ALLOYSHEETS):
+    """
+
+    Action
+        Ashby-style material selection over the alloys of `mats.xlsx`.
+
+    Arguments
+        `indices` : Performance indices to maximise.  Each one is either a
+        function of the dictionary of property arrays, e.g.
+        `lambda p: p["SYMPA"]**(2/3)/p["RHO"]`, or a tuple `(a, b, m)` for
+        `p[a]**m/p[b]`.
+
+        `where` : Constraints on the properties, `{prop: (low, high)}` with
+        `None` for an open end, or `{prop: value}`.
+
+        `x` :  Xcel pointer to `mats.xlsx`, or `None` for the shared one.
+
+        `bases` : Sheet names (see `alloytable`).
+
+    Returns
+        A dictionary with the alloys that meet the constraints and have all
+        the indices, ranked by the first index (largest first):
+
+        * "alloy", "base" : Designations and sheets
+
+        * "index" : n x len(indices) array of the performance indices
+
+        * "pareto" : True for the alloys on the Pareto front of the indices
+
+    Example
+        >>> r=alloyselect([("SYMPA", "RHO", 1), ("SYMPA", "RHO", 2/3)], where={"SUMPA": (500, None)})
+        >>> r["alloy"][r["pareto"]]
+
+    """
+    (names, sheets, p) = alloytable(x, bases=bases)
+    ok = np.ones(len(names), dtype=bool)
+    for (prop, condition) in where.items():
+        v = p[prop]
+        if type(condition) == tuple:
+            (low, high) = condition
+            if low != None:
+                ok &= v >= low
+            if high != None:
+                ok &= v <= high
+        else:
+            ok &= v == condition
+    scores = np.empty((len(names), len(indices)))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for (j, f) in enumerate(indices):
+            if type(f) == tuple:
+                (a, b, m) = f
+                scores[:, j] = p[a]**m/p[b]
+            else:
+                scores[:, j] = f(p)
+    ok &= np.isfinite(scores).all(axis=1)
+    rows = np.nonzero(ok)[0]
+    rows = rows[np.argsort(-scores[rows, 0], kind="stable")]
+    return {"alloy": names[rows], "base": sheets[rows], "index": scores[rows],
+            "pareto": paretofront(scores[rows])}
+
 # COLUMNS
 
 
@@ -404,10 +999,8 @@ def boltgrades(x, grade, props):
 
     """
     if x == None:
-        x = opendatafiles(tags=["mats"])[0]
-        x.sheet("bolts")
-    else:
-        x.sheet("bolts")
+        x = catalog("mats")
+    x = x.view("bolts")
     
     v = x.rnvit(1, "GRADE "+grade, props)
     return v
@@ -496,7 +1089,7 @@ def vbeltlengths(x, beltdes="5V", datumlength=673.0):
         z += '_Note_ :\n\n* "nnnnnn" is a number\n* "ssssss" is a string\n\n'
         return z
 
-    x.sheet("LENGTHS")
+    x = x.view("LENGTHS")
     for i in range(1, x.maxrow()):
         d = x.cell(i, 1)
         if d == beltdes:
@@ -569,7 +1162,7 @@ RETURN values read from Optibelt Tables 41 or 43:\n\n\
     if not beltdes in ["3V", "5V"]:
         print("vbeltpower: Unsupported belt designation.")
         return (0, 0)
-    x.sheet(beltdes+"POWER")
+    x = x.view(beltdes+"POWER")
     ncols = x.cell(1, 1)
     for j in range(2, ncols+1):
         d = x.cell(1, j)
@@ -616,7 +1209,7 @@ def vbeltc1(x, d, D, C):
 
     """
 
-    x.sheet("BETA")
+    x = x.view("BETA")
     r = abs(D-d)/C
     for i in range(2, x.maxrow()):
         if x.cell(i, 1) >= r:
@@ -1448,10 +2041,8 @@ def isofits(X=None, d=60.0, s="H7f6"):
         sys.exit(
             "LIBRARY.PY - isofits error.  Unknown shaft fit spec: %s" % s[2])
     if X == None:
-        X = opendatafiles(tags=["shaft"])[0]
-        X.sheet("fits")
-    else:
-        X.sheet("fits")
+        X = catalog("shaft")
+    X = X.view("fits")
     D = np.array([3, 6, 10, 18, 30, 50, 80, 120, 180, 250, 315, 400,
                   500, 630, 800, 1000, 1250.001])  # Basic sizes for H table
     if d>=1250.0:
@@ -1803,10 +2394,8 @@ def bearingpick(F, ncycles, xb=None, cr=1.0, dmin=np.array([0, 0]), record=False
     # else:
     #     xb.sheet("metric")
     if xb == None:
-        xb = opendatafiles(tags=["bearing"])[0]
-        xb.sheet("metric")
-    else:
-        xb.sheet("metric")
+        xb = catalog("bearing")
+    xb = xb.view("metric")
     Pd = np.max(np.abs(F))
     C = Pd*(ncycles/(cr*1.e6))**(1.0/3)
     d = np.min(dmin)
@@ -1842,13 +2431,11 @@ def bearingpick(F, ncycles, xb=None, cr=1.0, dmin=np.array([0, 0]), record=False
 
 def bearingdims(xb, bnum, name):
     if xb == None:
-        xb = Xcel("bearing.xlsx", sheetname="metric")
-    else:
-        xb.sheet("metric")
+        xb = catalog("bearing")
 
     dims = {'bore': 4, 'width': 6, "od": 5, "dmin": 10, "dmax": 11, "rmax": 9,
             "mass": 12, "C": 8, "Co": 7}
-    xb.sheet("metric")
+    xb = xb.view("metric")
     return xb.vir(bnum, dims[name])
 
 # r: Desired reliabilityy, e.g. 0.99 for 99%
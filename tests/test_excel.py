@@ -0,0 +1,178 @@
+import builtins
+import os
+import pickle
+import shutil
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+from melib import excel
+from melib.excel import Xcel, batchdiff, tablediff
+
+SHAFT = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "melib", "data", "shaft.xlsx")
+MATS = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "melib", "data", "mats.xlsx")
+
+
+def labels(x):
+    return [r[0] for r in x.ws.iter_rows(min_col=3, max_col=3, values_only=True) if r[0] != None]
+
+
+def samelookups(x, full):
+    for label in labels(full):
+        assert x.findrow(label) == full.findrow(label), label
+        for col in range(4, 12):
+            assert x.vir(label, col) == full.vir(label, col), (label, col)
+
+
+def test_compiled_fits_lookups():
+    full = Xcel(SHAFT, "fits")
+    x = Xcel(SHAFT, "fits", compiled=True)
+    assert "+2.5" in labels(full)
+    assert x.findrow("+2.5") == full.findrow("+2.5") != None
+    samelookups(x, full)
+
+
+def test_readonly_fits_lookups():
+    full = Xcel(SHAFT, "fits")
+    x = Xcel(SHAFT, "fits", readonly=True)
+    assert x.findrow("-25") == full.findrow("-25") != None
+    samelookups(x, full)
+    x.close()
+
+
+def test_findrow_after_sheet_grows():
+    x = Xcel()
+    x.cell(1, 3, "A")
+    assert x.findrow("A") == None
+    x.cell(1, 6, 1.0)
+    assert x.findrow("A") == 1
+
+
+def test_view_follows_parent():
+    x = Xcel(SHAFT, "fits")
+    v = x.view("fits")
+    x.celldefault(float, -1.0)
+    x.trace()
+    assert (v.wantedtype, v.exceptions, v.Trace) == (float, -1.0, True)
+    (hits, misses) = (x.cachehits, x.cachemisses)
+    v.vir("+2.5", 6)
+    v.vir("+2.5", 6)
+    assert x.cachemisses > misses and x.cachehits > hits
+    assert x.counts().get("cachehits", 0) > 0
+    x.evaluate()
+    assert v.Evaluate
+
+
+def test_template_cache_is_bounded(tmp_path):
+    excel.TEMPLATES.clear()
+    for k in range(excel.TEMPLATECACHE+2):
+        x = Xcel()
+        x.cell(2, 3, "LABEL%d" % k)
+        x.ws.cell(row=2, column=3).font = excel.Font(bold=True)
+        x.savefile(str(tmp_path / ("t%d.xlsx" % k)))
+        y = excel.excelfile(str(tmp_path / ("t%d.xlsx" % k)))
+        assert y.ws.cell(row=2, column=3).value == "LABEL%d" % k
+        assert y.ws.cell(row=2, column=3).font.bold
+    assert len(excel.TEMPLATES) == excel.TEMPLATECACHE
+    excel.excelfile(str(tmp_path / "t2.xlsx"))
+    assert list(excel.TEMPLATES)[-1][0].endswith("t2.xlsx")
+
+
+class Payload:
+    def __reduce__(self):
+        return (exec, ("import builtins; builtins.payloadran = True",))
+
+
+def test_compiled_ignores_cache_next_to_workbook(tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path / "home"))
+    folder = tmp_path / "submissions"
+    os.makedirs(folder / "__xlcache__")
+    shutil.copy(SHAFT, folder / "shaft.xlsx")
+    with open(folder / "__xlcache__" / "shaft.xlsx.pickle", "wb") as f:
+        pickle.dump(Payload(), f)
+    x = Xcel(str(folder / "shaft.xlsx"), "fits", compiled=True)
+    assert not hasattr(builtins, "payloadran")
+    assert x.findrow("+2.5") == Xcel(SHAFT, "fits").findrow("+2.5")
+    assert os.listdir(tmp_path / "home" / ".cache" / "melib")
+
+
+def test_opendatafiles_is_writable():
+    from melib.library import opendatafiles
+    x = opendatafiles(["shaft"])[0]
+    x.sheet("fits")
+    x.cell(1, 1, "edited")
+    assert x.cell(1, 1) == "edited"
+
+
+def test_copyfile_shares_styles():
+    x = Xcel(SHAFT, "fits")
+    template = excel.Template(x)
+    y = Xcel()
+    template.stamp(y)
+    assert len(y.wb.named_styles) == len(template.styles)+1  # And "Normal"
+    for row in x.ws.iter_rows(max_row=40):
+        for cell in row:
+            cello = y.ws.cell(row=cell.row, column=cell.column)
+            assert cello.number_format == cell.number_format
+            assert (cello.font.name, cello.font.sz, cello.font.b) == (cell.font.name, cell.font.sz, cell.font.b)
+    template.stamp(y)
+    assert len(y.wb.named_styles) == len(template.styles)+1
+
+
+def submissions(folder):
+    files = []
+    for k in range(3):
+        x = Xcel(MATS, "alum")
+        first = x.findtable(1)+5
+        for i in range(k):
+            x.cell(first+3*i, 6, 1.0+i)  # k mismatches
+        files.append(os.path.join(folder, "s%d.xlsx" % k))
+        x.savefile(files[-1])
+    with open(os.path.join(folder, "broken.xlsx"), "w") as f:
+        f.write("not a workbook")
+    return files+[os.path.join(folder, "broken.xlsx"), os.path.join(folder, "missing.xlsx")]
+
+
+def test_batchdiff_equals_tablediff(tmp_path):
+    files = submissions(str(tmp_path))
+    ref = Xcel(MATS, "alum")
+    for processes in [1, 2]:
+        reports = {r["file"]: r for r in batchdiff(1, MATS, files, sheetname="alum",
+                                                   processes=processes, verbose=False)}
+        assert sorted(reports) == sorted(files)
+        for (k, f) in enumerate(files[:3]):
+            assert reports[f]["error"] == None
+            assert reports[f]["mismatches"] == tablediff(1, ref, Xcel(f, "alum"))
+            assert len(reports[f]["mismatches"]) == k
+        assert reports[files[3]]["error"] != None
+        assert "cannot be found" in reports[files[4]]["error"]
+
+
+def test_params_dict_equals_vir():
+    x = Xcel()
+    x.evaluate()
+    for (k, (label, value)) in enumerate([("A", 2.0), ("B", "=F1*3"), ("C", "=F2+F1"), ("D", "text"), ("A", 5.0)]):
+        x.cell(k+1, 3, label)
+        x.cell(k+1, 6, value)
+    assert x.params(["B"]) == [6.0]
+    d = x.params_dict()
+    assert d["B"] == 6.0 and d["C"] == 8.0
+    for name in ["A", "B", "C", "D"]:
+        assert d[name] == x.vir(name)
+    x.cell(1, 6, 1.0)
+    assert x.params_dict()["C"] == x.vir("C") == 4.0
+    for sheetname in ["data", "fits"]:
+        y = Xcel(SHAFT, sheetname)
+        d = y.params_dict()
+        for name in d:
+            assert d[name] == y.vir(name), name
+
+
+def test_tracing_a_view():
+    x = Xcel(SHAFT, "fits")
+    v = x.view("fits")
+    with excel.tracing(v) as counts:
+        assert v.Trace and x.Trace
+        v.vir("+2.5", 6)
+    assert not x.Trace and not v.Trace
+    assert "Trace" not in x.__dict__
+    assert counts["reads"] == 1
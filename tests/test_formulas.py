@@ -0,0 +1,83 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+from melib.excel import Xcel, Xlerror
+
+
+# An Xcel that evaluates its formulas, with "cells" written in column A
+def sheet(cells):
+    x = Xcel()
+    x.evaluate()
+    for (row, value) in enumerate(cells):
+        x.cell(row+1, 1, value)
+    return x
+
+
+def value(formula, cells=[]):
+    x = sheet(cells)
+    x.cell(100, 2, formula)
+    return x.cell(100, 2)
+
+
+def test_precedence():
+    assert value("=1+2*3") == 7
+    assert value("=(1+2)*3") == 9
+    assert value("=2^3^2") == 64  # Left to right, as in Excel
+    assert value("=-2^2") == 4  # The minus sign binds first
+    assert value("=10-4-3") == 3
+    assert value("=12/3/2") == 2
+    assert value("=50%*4") == 2
+    assert value('=1+2&"x"') == "3x"
+    assert value("=1+1=2") == True
+    assert value("=2*3>5") == True
+
+
+def test_functions():
+    cells = [1.0, 2.0, "text", None, 5.0]
+    assert value("=SUM(A1:A5)", cells) == 8
+    assert value("=SUM(A1:A5,10,A1)", cells) == 19
+    assert value("=MIN(A1:A5)", cells) == 1
+    assert value("=MAX(A1:A5)", cells) == 5
+    assert value("=MAX(A4:A4)", cells) == 0
+    assert value("=IF(A1>0,\"pos\",\"neg\")", cells) == "pos"
+    assert value("=IF(A1<0,1)", cells) == False
+    assert value("=INDEX(A1:A5,2)", cells) == 2
+    assert value("=MATCH(5,A1:A5,0)", cells) == 5
+    assert value("=MATCH(2.5,A1:A2)", cells) == 2
+    assert value("=INDEX(A1:A5,MATCH(\"TEXT\",A1:A5,0))", cells) == "text"
+
+
+def test_errors():
+    assert value("=1/0") == Xlerror("#DIV/0!")
+    assert value("=0^-1") == Xlerror("#DIV/0!")
+    assert value("=(-8)^(1/3)") == Xlerror("#NUM!")
+    assert value("=10^400") == Xlerror("#NUM!")
+    assert value("=NOSUCH(1)") == Xlerror("#NAME?")
+    assert value("=1+") == Xlerror("#NAME?")
+    assert value('="a"+1') == Xlerror("#VALUE!")
+    assert value("=INDEX(A1:A2,3)", [1.0, 2.0]) == Xlerror("#REF!")
+    assert value("=MATCH(9,A1:A2,0)", [1.0, 2.0]) == Xlerror("#N/A")
+    assert value("=A1+1", ["=1/0"]) == Xlerror("#DIV/0!")
+    assert isinstance(value("=(-8)^(1/3)"), Xlerror)
+
+
+def test_circular_references():
+    x = sheet(["=A2", "=A1+1", "=A3"])
+    assert x.cell(1, 1) == Xlerror("#REF!")
+    assert x.cell(2, 1) == Xlerror("#REF!")
+    assert x.cell(3, 1) == Xlerror("#REF!")
+
+
+def test_recalculation():
+    x = sheet([2.0, "=A1*3", "=A2+A1", "=SUM(A1:A3)", 7.0, "=A5*2"])
+    assert [x.cell(k, 1) for k in range(1, 7)] == [2, 6, 8, 16, 7, 14]
+    x.cell(1, 1, 10.0)
+    assert [x.cell(k, 1) for k in range(1, 7)] == [10, 30, 40, 80, 7, 14]
+    x.cell(2, 1, "=A1-1")  # A new formula
+    assert [x.cell(k, 1) for k in range(2, 5)] == [9, 19, 38]
+    x.cell(1, 1, 0.0)
+    x.cell(6, 1, "=1/A1")
+    assert x.cell(6, 1) == Xlerror("#DIV/0!")
+    x.cell(1, 1, 4.0)
+    assert x.cell(6, 1) == 0.25
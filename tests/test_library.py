@@ -0,0 +1,104 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+from melib.excel import Xcel
+from melib.library import UNITS, alloyprop, alloyprops, paretofront, unitconvert
+
+MATS = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "melib", "data", "mats.xlsx")
+
+
+# The table by table search of the sheet that alloyprop replaces
+def oldalloyprop(x, base, alloyname, props):
+    x.sheet(base)
+    noftables = x.vir("NOFTABLES")
+    tablenum = 1
+    v = x.rnvit(tablenum, alloyname, props)
+    while np.isnan(v[0]) and tablenum < noftables:
+        tablenum += 1
+        v = x.rnvit(tablenum, alloyname, props)
+    return v
+
+
+def test_alloyprop_missing_first_prop():
+    x = Xcel(MATS)
+    y = Xcel(MATS)
+    cases = [("steel", "1020 HOT-ROLLED", ["NOPE", "SUMPA"]),  # Only in table 1
+             ("steel", "SAE 1018", ["DUCTIL", "SUMPA"]),  # In tables 1 and 2
+             ("steel", "SAE 1018", ["SUMPA", "DUCTIL"]),
+             ("alum", "1350-H19", ["NOPE", "SUMPA"])]
+    for (base, alloyname, props) in cases:
+        v = oldalloyprop(y, base, alloyname, props)
+        assert np.array_equal(alloyprop(x, base, alloyname, props), v, equal_nan=True), (base, alloyname, props)
+        assert np.array_equal(alloyprops(x, base, [alloyname], props)[0], v, equal_nan=True), (base, alloyname, props)
+    assert np.isnan(alloyprop(x, "steel", "1020 HOT-ROLLED", ["NOPE", "SUMPA"])).all()
+
+
+def test_rowindex_after_table_number_change():
+    x = Xcel(MATS, "steel")
+    assert alloyprop(x, "steel", "1020 HOT-ROLLED", ["SUMPA"])[0] == 379.0
+    x.cell(x.findtable(1), 4, 7)
+    assert [s for s in x.rowindex()["1020 HOT-ROLLED"] if s[0] == "steel"][0][1] == 7
+
+
+def test_negative_exponents():
+    assert UNITS.factor("s^-1", "1/s") == 1.0
+    assert UNITS.factor("kg-m-s^-2", "N") == 1.0
+    assert UNITS.factor("kg-m2-s^-2", "J") == 1.0
+    assert UNITS.factor("m-s^-1", "m/s") == 1.0
+    with pytest.raises(ValueError):
+        UNITS.factor("s^-1", "s")
+
+
+def test_unknown_units():
+    for name in ["Mm", "MG", "furlong"]:
+        with pytest.raises(KeyError):
+            UNITS.factor(name, "m")
+    assert UNITS.factor("Kg", "g") == 1000.0
+    assert UNITS.factor("sec", "min") == 1/60
+
+
+def test_original_pairs():
+    assert unitconvert("Calories_per_Cm2Min", "W_per_M2") == 697
+    assert unitconvert("Grams_per_Dm2Hr", "Kg_per_M2H") == 4e-05
+    assert unitconvert("Lbf_inch", "N-m") == 0.113
+    assert unitconvert("Kg_per_M2H", "Grams_per_Dm2Hr") == 1/4e-05
+    for (a, b) in [("Grams_per_Dm2Hr", "kg/m2-h"), ("g/dm2-h", "Kg_per_M2H"), ("Lbf_inch", "lbf-in"),
+                   ("Calories_per_Cm2Min", "W/m2")]:
+        with pytest.raises(KeyError):
+            unitconvert(a, b)
+
+
+def test_chained_conversions():
+    chains = [("lbf-in", "N-m", "J"), ("kg/m2-h", "g/dm2-h", "lb/ft2-min"), ("cal/cm2-min", "W/m2", "kW/cm2"),
+              ("ksi", "MPa", "N/mm2"), ("rpm", "rad/s", "deg/min"), ("kg-m-s^-2", "N", "kgf")]
+    for (a, b, c) in chains:
+        assert abs(unitconvert(a, b)*unitconvert(b, c)/unitconvert(a, c)-1) < 1e-12, (a, b, c)
+
+
+# Row i is on the front if no other row (without NaN) dominates it
+def bruteparetofront(scores):
+    ok = ~np.isnan(scores).any(axis=1)
+    front = np.zeros(len(scores), dtype=bool)
+    for i in np.nonzero(ok)[0]:
+        others = scores[ok]
+        front[i] = not ((others >= scores[i]).all(axis=1) & (others > scores[i]).any(axis=1)).any()
+    return front
+
+
+def test_paretofront_brute_force():
+    rng = np.random.default_rng(1)
+    for k in [1, 2, 3, 4]:
+        for n in [1, 5, 40, 300, 700]:  # More than 256 rows for the blocks of k>2
+            scores = rng.integers(0, 6, size=(n, k)).astype(float)  # Many ties
+            scores[rng.random(n) < 0.1, rng.integers(0, k)] = np.nan
+            if n > 5:
+                scores[n//2] = scores[n//3]  # Identical rows
+            assert np.array_equal(paretofront(scores), bruteparetofront(scores)), (k, n)
+            scores = rng.random((n, k))
+            assert np.array_equal(paretofront(scores), bruteparetofront(scores)), (k, n)
+    assert not paretofront(np.full((3, 2), np.nan)).any()
+    assert paretofront([[1.0, 1.0], [1.0, 1.0]]).all()